@@ -0,0 +1,97 @@
+import os
+import time
+
+import requests
+
+from common import log, conn as redis_conn, ADMIN_NOTIFICATIONS_KEY
+
+# Sends the messages queued by send_admin_notification to the admin webhook. Messages
+# that come in close together get sent as one, so a burst of tips or errors doesn't
+# turn into a burst of webhook requests.
+#
+# Messages being sent are kept in a second list until the webhook accepts them, so
+# if the notifier stops partway through they get sent when it starts again.
+
+SENDING_KEY = f"{ADMIN_NOTIFICATIONS_KEY}:sending"
+
+# After the first message, wait this many seconds for more to send along with it
+BATCH_WINDOW = 5
+MAX_BATCH_SIZE = 50
+
+REQUEST_TIMEOUT = 10
+MAX_TRIES = 5
+RETRY_DELAY = 30
+
+
+def next_batch():
+    """
+    Wait for messages, and return them once the batch window is over or the batch is
+    full. Each message is moved to the sending list as it's taken off the queue.
+    """
+    messages = [redis_conn.brpoplpush(ADMIN_NOTIFICATIONS_KEY, SENDING_KEY, 0)]
+    batch_end = time.monotonic() + BATCH_WINDOW
+    while len(messages) < MAX_BATCH_SIZE:
+        wait = int(batch_end - time.monotonic())
+        if wait <= 0:
+            break
+        message = redis_conn.brpoplpush(ADMIN_NOTIFICATIONS_KEY, SENDING_KEY, wait)
+        if message is None:
+            break
+        messages.append(message)
+    return [message.decode() for message in messages]
+
+
+def send(webhook_url, messages):
+    """
+    Post the messages to the webhook as one message, trying again with backoff if it
+    fails
+    """
+    for i in range(MAX_TRIES):
+        try:
+            response = requests.post(
+                webhook_url, data="\n\n".join(messages), timeout=REQUEST_TIMEOUT
+            )
+            response.raise_for_status()
+            return True
+        except Exception as e:
+            delay = RETRY_DELAY * 2**i
+            log(
+                None,
+                f"admin_notifier: error sending {len(messages)} messages (try {i + 1}/{MAX_TRIES}): {e}",
+            )
+            if i < MAX_TRIES - 1:
+                time.sleep(delay)
+    return False
+
+
+def main():
+    webhook_url = os.environ.get("ADMIN_WEBHOOK")
+    if not webhook_url:
+        # Nothing gets queued without a webhook, so just stay up so docker doesn't
+        # keep restarting us
+        log(None, "admin_notifier: ADMIN_WEBHOOK isn't set, nothing to do")
+        while True:
+            time.sleep(3600)
+
+    # Send anything that was being sent when the notifier last stopped (the sending
+    # list has the newest message first)
+    leftover = [
+        message.decode() for message in reversed(redis_conn.lrange(SENDING_KEY, 0, -1))
+    ]
+    if leftover:
+        log(None, f"admin_notifier: sending {len(leftover)} leftover messages")
+        send(webhook_url, leftover)
+        redis_conn.delete(SENDING_KEY)
+
+    while True:
+        messages = next_batch()
+        if not send(webhook_url, messages):
+            log(
+                None,
+                f"admin_notifier: giving up on {len(messages)} messages: {messages}",
+            )
+        redis_conn.delete(SENDING_KEY)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+"""add attempts to job details
+
+Revision ID: 1f6a3b8d2c57
+Revises: 5e8b1c3d9a47
+Create Date: 2026-10-19 18:42:16.503817
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "1f6a3b8d2c57"
+down_revision = "5e8b1c3d9a47"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # How many times the postgres job queue has tried a job and had it fail
+    op.add_column(
+        "job_details",
+        sa.Column("attempts", sa.Integer, nullable=False, server_default="0"),
+    )
+
+
+def downgrade():
+    op.drop_column("job_details", "attempts")
@@ -0,0 +1,29 @@
+"""add finished jobs index
+
+Revision ID: 3c7e9d2a4f18
+Revises: d41f8a6b2c93
+Create Date: 2026-10-19 14:22:51.309412
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "3c7e9d2a4f18"
+down_revision = "d41f8a6b2c93"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # For paging through a user's finished jobs on the dashboard
+    op.create_index(
+        "job_details_user_id_status_finished_timestamp_idx",
+        "job_details",
+        ["user_id", "status", sa.text("finished_timestamp DESC"), sa.text("id DESC")],
+    )
+
+
+def downgrade():
+    op.drop_index("job_details_user_id_status_finished_timestamp_idx")
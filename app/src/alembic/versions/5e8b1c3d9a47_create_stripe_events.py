@@ -0,0 +1,32 @@
+"""create stripe events
+
+Revision ID: 5e8b1c3d9a47
+Revises: 7a2d4e6f8b10
+Create Date: 2026-10-19 16:31:05.274190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "5e8b1c3d9a47"
+down_revision = "7a2d4e6f8b10"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "stripe_events",
+        sa.Column("id", sa.String, primary_key=True),
+        sa.Column("event_type", sa.String),
+        sa.Column("payload", sa.String),
+        sa.Column("status", sa.String),
+        sa.Column("received_timestamp", sa.DateTime),
+        sa.Column("processed_timestamp", sa.DateTime),
+    )
+
+
+def downgrade():
+    op.drop_table("stripe_events")
@@ -0,0 +1,29 @@
+"""add users screen name prefix index
+
+Revision ID: 7a2d4e6f8b10
+Revises: 3c7e9d2a4f18
+Create Date: 2026-10-19 15:40:12.518734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "7a2d4e6f8b10"
+down_revision = "3c7e9d2a4f18"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # For searching users by the start of their screen name in the admin
+    op.create_index(
+        "users_lower_twitter_screen_name_idx",
+        "users",
+        [sa.text("lower(twitter_screen_name) text_pattern_ops")],
+    )
+
+
+def downgrade():
+    op.drop_index("users_lower_twitter_screen_name_idx")
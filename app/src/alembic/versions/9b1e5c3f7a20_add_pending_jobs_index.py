@@ -0,0 +1,30 @@
+"""add pending jobs index
+
+Revision ID: 9b1e5c3f7a20
+Revises: 2862c7d15fe2
+Create Date: 2026-10-19 10:12:44.318201
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "9b1e5c3f7a20"
+down_revision = "2862c7d15fe2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Lets workers using the postgres job queue find the next job to claim quickly
+    op.create_index(
+        "job_details_pending_scheduled_timestamp_idx",
+        "job_details",
+        ["scheduled_timestamp"],
+        postgresql_where=sa.text("status = 'pending'"),
+    )
+
+
+def downgrade():
+    op.drop_index("job_details_pending_scheduled_timestamp_idx")
@@ -0,0 +1,50 @@
+"""unique pending job per user
+
+Revision ID: d41f8a6b2c93
+Revises: 9b1e5c3f7a20
+Create Date: 2026-10-19 11:03:27.845116
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "d41f8a6b2c93"
+down_revision = "9b1e5c3f7a20"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Cancel duplicate jobs, keeping the active one or else the oldest pending one
+    op.execute(
+        """
+UPDATE job_details SET status = 'canceled', finished_timestamp = NOW()
+WHERE id IN (
+    SELECT id FROM (
+        SELECT
+            id,
+            ROW_NUMBER() OVER (
+                PARTITION BY user_id, job_type
+                ORDER BY status = 'active' DESC, id
+            ) AS n
+        FROM job_details
+        WHERE status IN ('pending', 'active') AND user_id IS NOT NULL
+    ) AS jobs
+    WHERE n > 1
+)
+"""
+    )
+
+    op.create_index(
+        "job_details_user_id_job_type_pending_idx",
+        "job_details",
+        ["user_id", "job_type"],
+        unique=True,
+        postgresql_where=sa.text("status IN ('pending', 'active')"),
+    )
+
+
+def downgrade():
+    op.drop_index("job_details_user_id_job_type_pending_idx")
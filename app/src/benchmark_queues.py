@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+import time
+import click
+from datetime import datetime
+
+from sqlalchemy import delete
+from db import JobDetails, engine as db_engine, session as db_session
+
+from common import conn as redis_conn
+import pg_queue
+from worker_jobs import benchmark_noop
+
+from rq import Queue, Worker
+
+# Compares the throughput of the rq job queue with the postgres job queue. Every job
+# is a no-op that marks its JobDetails finished, so this measures the overhead of the
+# queues themselves. Run it against a staging database, not prod.
+
+
+def _add_job_details():
+    job_details = JobDetails(
+        job_type="benchmark", data="{}", scheduled_timestamp=datetime.now()
+    )
+    db_session.add(job_details)
+    db_session.commit()
+    return job_details
+
+
+def _cleanup():
+    db_session.execute(delete(JobDetails).where(JobDetails.job_type == "benchmark"))
+    db_session.commit()
+
+
+def benchmark_rq(num_jobs):
+    q = Queue("benchmark", connection=redis_conn)
+    q.empty()
+
+    start = time.time()
+    for _ in range(num_jobs):
+        # The same bookkeeping as common.add_job
+        job_details = _add_job_details()
+        redis_job = q.enqueue("worker_jobs.benchmark_noop", job_details.id)
+        job_details.redis_id = redis_job.id
+        db_session.add(job_details)
+        db_session.commit()
+    enqueued = time.time()
+
+    # Don't share database connections with the forked work horses
+    db_engine.dispose()
+    Worker([q], connection=redis_conn).work(burst=True, logging_level="WARNING")
+    finished = time.time()
+
+    return enqueued - start, finished - enqueued
+
+
+def benchmark_postgres(num_jobs):
+    start = time.time()
+    for _ in range(num_jobs):
+        _add_job_details()
+    enqueued = time.time()
+
+    while pg_queue.run_next_job(["benchmark"], {"benchmark": benchmark_noop}):
+        pass
+    finished = time.time()
+
+    return enqueued - start, finished - enqueued
+
+
+@click.command()
+@click.option("--jobs", "num_jobs", default=1000, help="Number of jobs to run")
+def main(num_jobs):
+    """Benchmark the rq and postgres job queues"""
+    for name, benchmark in [("rq", benchmark_rq), ("postgres", benchmark_postgres)]:
+        _cleanup()
+        enqueue_time, run_time = benchmark(num_jobs)
+        total_time = enqueue_time + run_time
+        print(
+            f"{name}: enqueued {num_jobs:,} jobs in {enqueue_time:.2f}s ({num_jobs / enqueue_time:,.0f}/s), "
+            + f"ran them in {run_time:.2f}s ({num_jobs / run_time:,.0f}/s), "
+            + f"total {num_jobs / total_time:,.0f} jobs/s"
+        )
+    _cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import time
+import asyncio
+import tempfile
+import click
+
+import tweepy
+import urllib3
+
+from benchmark_twitter_clients import FakeTwitterHandler, start_fake_twitter
+from twitter_async import AsyncTwitterAPI
+
+# Compares deleting tweets one at a time with tweepy, like the delete job's loop does,
+# against deleting them with the async client. Requests go to a fake twitter API
+# running locally that waits --latency seconds before responding.
+
+
+def benchmark_sequential(server, tweet_ids):
+    auth = tweepy.OAuth1UserHandler("key", "secret", "token", "token_secret")
+    api = tweepy.API(auth)
+    api.host = f"127.0.0.1:{server.server_port}"
+    api.session.verify = False
+
+    start = time.time()
+    for tweet_id in tweet_ids:
+        try:
+            api.destroy_status(tweet_id)
+        except Exception:
+            pass
+    return time.time() - start
+
+
+async def _delete_async(server, tweet_ids, concurrency):
+    async with AsyncTwitterAPI(
+        "key",
+        "secret",
+        "token",
+        "token_secret",
+        concurrency=concurrency,
+        host=f"127.0.0.1:{server.server_port}",
+        verify_ssl=False,
+    ) as api:
+        await asyncio.gather(
+            *[api.destroy_status(tweet_id) for tweet_id in tweet_ids],
+            return_exceptions=True,
+        )
+
+
+def benchmark_async(server, tweet_ids, concurrency):
+    start = time.time()
+    asyncio.run(_delete_async(server, tweet_ids, concurrency))
+    return time.time() - start
+
+
+@click.command()
+@click.option("--tweets", "num_tweets", default=500, help="Number of tweets to delete")
+@click.option("--latency", default=0.05, help="Seconds the fake API takes to respond")
+@click.option("--concurrency", default=20, help="Requests in flight for async")
+def main(num_tweets, latency, concurrency):
+    """Benchmark deleting tweets sequentially with tweepy against the async client"""
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    FakeTwitterHandler.latency = latency
+    tweet_ids = [str(1000000 + i) for i in range(num_tweets)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        server = start_fake_twitter(tmp_dir)
+        for name, benchmark in [
+            ("sequential", lambda: benchmark_sequential(server, tweet_ids)),
+            (
+                f"async ({concurrency} in flight)",
+                lambda: benchmark_async(server, tweet_ids, concurrency),
+            ),
+        ]:
+            FakeTwitterHandler.connections = 0
+            elapsed = benchmark()
+            print(
+                f"{name}: deleted {num_tweets:,} tweets in {elapsed:.2f}s ({num_tweets / elapsed:,.0f}/s), "
+                + f"opened {FakeTwitterHandler.connections:,} connections"
+            )
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+import os
+import ssl
+import json
+import time
+import tempfile
+import threading
+import subprocess
+import click
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import tweepy
+import urllib3
+
+from common import create_tweepy_api_1_1, twitter_client_pool
+
+# Compares making twitter API calls with a new tweepy.API for every call (like we
+# used to) against getting them from the client pool. Calls go to a fake twitter
+# API running locally over HTTPS, which counts how many connections get opened.
+
+
+class FakeTwitterHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = 0
+    lock = threading.Lock()
+
+    # Seconds to wait before responding, to act more like a real API
+    latency = 0
+
+    def setup(self):
+        super().setup()
+        with FakeTwitterHandler.lock:
+            FakeTwitterHandler.connections += 1
+
+    def do_GET(self):
+        # Read the request body, if there is one, so the connection can be reused
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            self.rfile.read(length)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        body = json.dumps(
+            {
+                "id": 1,
+                "id_str": "1",
+                "screen_name": "benchmark",
+                "profile_image_url_https": "https://localhost/egg.png",
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+    do_DELETE = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_twitter(tmp_dir):
+    cert_path = os.path.join(tmp_dir, "cert.pem")
+    key_path = os.path.join(tmp_dir, "key.pem")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=127.0.0.1",
+            "-keyout",
+            key_path,
+            "-out",
+            cert_path,
+        ],
+        check=True,
+        capture_output=True,
+    )
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_path, key_path)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeTwitterHandler)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _point_at(api, server):
+    api.host = f"127.0.0.1:{server.server_port}"
+    api.session.verify = False
+    return api
+
+
+def new_api(token):
+    auth = tweepy.OAuth1UserHandler("key", "secret", token, "token_secret")
+    return tweepy.API(auth, wait_on_rate_limit=True)
+
+
+def pooled_api(token):
+    return create_tweepy_api_1_1("key", "secret", token, "token_secret")
+
+
+def run(server, get_api, num_calls, num_users):
+    FakeTwitterHandler.connections = 0
+    start = time.time()
+    for i in range(num_calls):
+        api = _point_at(get_api(f"token-{i % num_users}"), server)
+        api.verify_credentials()
+    return time.time() - start, FakeTwitterHandler.connections
+
+
+@click.command()
+@click.option("--calls", "num_calls", default=1000, help="Number of API calls")
+@click.option("--users", "num_users", default=20, help="Number of access tokens")
+def main(num_calls, num_users):
+    """Benchmark new tweepy clients for every call against pooled clients"""
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        server = start_fake_twitter(tmp_dir)
+        for name, get_api in [("new client", new_api), ("pooled", pooled_api)]:
+            twitter_client_pool.clear()
+            elapsed, connections = run(server, get_api, num_calls, num_users)
+            print(
+                f"{name}: {num_calls:,} calls in {elapsed:.2f}s ({num_calls / elapsed:,.0f}/s), "
+                + f"opened {connections:,} connections"
+            )
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,21 +2,59 @@ import os
 import sys
 import requests
 import json
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 import tweepy
 
-from sqlalchemy import select, delete
-from db import Tweet, Like, Thread, Nag, JobDetails, Tip, session as db_session
+from sqlalchemy import select, update, delete, func, event, inspect
+from sqlalchemy.dialects.postgresql import insert
+from db import User, Tweet, Like, Thread, Nag, JobDetails, Tip, session as db_session
 
 import redis
 from rq import Queue
 
 conn = redis.from_url(os.environ.get("REDIS_URL"))
-jobs_q = Queue("jobs", connection=conn)
 dm_jobs_high_q = Queue("dm_jobs_high", connection=conn)
 dm_jobs_low_q = Queue("dm_jobs_low", connection=conn)
 
+# Jobs are split into classes with their own queues, so that one user's first fetch
+# or delete can't hold up everyone's daily incremental jobs:
+# - short: incremental fetch and delete, block, unblock
+# - long: first fetches, and deletes with lots of tweets and likes to go through
+# - bulk_dms: deleting DMs from a twitter archive
+jobs_q = Queue("jobs", connection=conn)
+jobs_long_q = Queue("jobs_long", connection=conn)
+jobs_bulk_dms_q = Queue("jobs_bulk_dms", connection=conn)
+job_class_queues = {"short": jobs_q, "long": jobs_long_q, "bulk_dms": jobs_bulk_dms_q}
+
+# Delete jobs with more tweets and likes than this are long jobs
+LONG_JOB_COST = int(os.environ.get("LONG_JOB_COST", 5000))
+
+# Fetching everything can pull in up to 3,200 tweets and 3,200 likes
+FIRST_FETCH_COST = 6400
+BULK_DMS_COST = 10000
+
+# "rq" keeps jobs in redis queues. "postgres" has workers claim jobs straight from the
+# job_details table (see pg_queue.py), so nothing gets enqueued in redis.
+JOB_QUEUE_BACKEND = os.environ.get("JOB_QUEUE_BACKEND", "rq")
+
+# Workers push the ids of failed jobs here, so monitor can retry them right away
+FAILED_JOBS_KEY = "monitor:failed_jobs"
+
+# Monitor sets this once it has finished putting pending jobs back in the queues, and
+# keeps refreshing it while it runs. It expires on its own, so if redis still has it
+# from before a restart, workers don't start before monitor is ready again.
+MONITOR_READY_KEY = "monitor:ready"
+MONITOR_READY_TTL = 30
+
+# Workers keep track of how long jobs take to start running here
+STARTUP_LATENCY_KEY = "worker:startup_latency"
+
 
 def log(job_details, s):
     # Print to stderr, so we can immediately see output in docker logs
@@ -29,9 +67,182 @@ def log(job_details, s):
         print(f"[{datetime.now().strftime('%c')}] {s}", file=sys.stderr)
 
 
-# Add a job
+# The web app caches users in redis (see web._get_user). Their twitter credentials
+# aren't cached, those always get loaded from the database.
+USER_CACHE_CREDENTIAL_COLUMNS = [
+    "twitter_access_token",
+    "twitter_access_token_secret",
+    "twitter_dms_access_token",
+    "twitter_dms_access_token_secret",
+]
+
+
+def user_cache_key(twitter_id):
+    return f"user_row:{twitter_id}"
+
+
+@event.listens_for(db_session, "after_flush")
+def _invalidate_cached_users(flush_session, flush_context):
+    """
+    Whenever a user gets saved or deleted, in the web app or in a job, drop them from
+    the redis cache
+    """
+    for obj in list(flush_session.dirty) + list(flush_session.deleted):
+        if isinstance(obj, User):
+            twitter_id = inspect(obj).dict.get("twitter_id")
+            if twitter_id:
+                conn.delete(user_cache_key(twitter_id))
+
+
+def invalidate_all_cached_users():
+    """
+    For when users get changed with an UPDATE statement instead of one at a time
+    """
+    for key in conn.scan_iter(user_cache_key("*")):
+        conn.delete(key)
+
+
+def report_job_failure(job, exc_type, exc_value, traceback):
+    """
+    rq exception handler, lets monitor know a job failed
+    """
+    pipeline = conn.pipeline()
+    pipeline.rpush(FAILED_JOBS_KEY, job.id)
+    pipeline.ltrim(FAILED_JOBS_KEY, -10000, -1)
+    pipeline.execute()
+
+    # Let the rest of the exception handlers run too
+    return True
+
+
+def estimate_job_costs(jobs):
+    """
+    Takes a list of JobDetails and returns a dict mapping each id to a (job_class,
+    cost) tuple, where cost is roughly how many tweets and likes the job will go
+    through. Counts for the whole list are loaded in one query each. Delete jobs that
+    will only look at what changed use the cost saved in their delete plan instead.
+    """
+    delete_user_ids = list(
+        {
+            job_details.user_id
+            for job_details in jobs
+            if job_details.user_id and job_details.job_type == "delete"
+        }
+    )
+    incremental_costs = {}
+    if delete_user_ids:
+        now = time.time()
+        plans = conn.mget([_delete_plan_key(user_id) for user_id in delete_user_ids])
+        for user_id, plan in zip(delete_user_ids, plans):
+            cost = incremental_delete_cost(json.loads(plan) if plan else None, now)
+            if cost is not None:
+                incremental_costs[user_id] = cost
+
+    user_ids = {
+        job_details.user_id
+        for job_details in jobs
+        if job_details.user_id
+        and job_details.job_type in ["fetch", "delete"]
+        and not (
+            job_details.job_type == "delete"
+            and job_details.user_id in incremental_costs
+        )
+    }
+    since_ids = {}
+    counts = {}
+    if user_ids:
+        since_ids = dict(
+            db_session.execute(
+                select(User.id, User.since_id).where(User.id.in_(user_ids))
+            ).all()
+        )
+        for table in [Tweet, Like]:
+            for user_id, count in db_session.execute(
+                select(table.user_id, func.count(table.id))
+                .where(table.user_id.in_(user_ids))
+                .where(table.is_deleted == False)
+                .group_by(table.user_id)
+            ):
+                counts[user_id] = counts.get(user_id, 0) + count
+
+    costs = {}
+    for job_details in jobs:
+        if job_details.job_type in ["delete_dms", "delete_dm_groups"]:
+            costs[job_details.id] = ("bulk_dms", BULK_DMS_COST)
+        elif job_details.job_type == "fetch" and not since_ids.get(
+            job_details.user_id
+        ):
+            costs[job_details.id] = ("long", FIRST_FETCH_COST)
+        elif job_details.job_type in ["fetch", "delete"]:
+            cost = counts.get(job_details.user_id, 0)
+            if job_details.job_type == "delete":
+                cost = incremental_costs.get(job_details.user_id, cost)
+            elif job_details.job_type == "fetch":
+                # Incremental fetches only go through new tweets, but they still
+                # update threads
+                cost = min(cost, LONG_JOB_COST) // 10
+            job_class = "long" if cost > LONG_JOB_COST else "short"
+            costs[job_details.id] = (job_class, max(cost, 1))
+        else:
+            costs[job_details.id] = ("short", 1)
+    return costs
+
+
+def job_queue_and_meta(job_details, cost=None):
+    """
+    Which queue a job belongs in, and the meta for its rq job. If the caller already
+    knows the job's cost it's used instead of estimating it.
+    """
+    if cost is None:
+        job_class, cost = estimate_job_costs([job_details])[job_details.id]
+    else:
+        job_class = "long" if cost > LONG_JOB_COST else "short"
+        cost = max(cost, 1)
+    return job_class_queues[job_class], {"job_class": job_class, "cost": cost}
+
+
+# Daily jobs run in the user's own slot of the day, so they don't all pile up at the
+# times we happened to deploy
+DAILY_SLOTS = 96
+DAILY_SLOT_SECONDS = 86400 // DAILY_SLOTS
+
+# Never run a daily job sooner than this after the last run
+DAILY_MIN_GAP = timedelta(hours=12)
+
+
+def daily_slot(user_id):
+    """
+    The user's slot of the day. It's the same every time, and users are spread
+    evenly across the slots.
+    """
+    digest = hashlib.sha256(str(user_id).encode()).digest()
+    return int.from_bytes(digest[:4], "big") % DAILY_SLOTS
+
+
+def next_daily_run(user_id, after=None):
+    """
+    The next time the user's daily slot comes around, at least DAILY_MIN_GAP from now
+    """
+    if not after:
+        after = datetime.now()
+    earliest = after + DAILY_MIN_GAP
+    day = earliest.replace(hour=0, minute=0, second=0, microsecond=0)
+    run_at = day + timedelta(seconds=daily_slot(user_id) * DAILY_SLOT_SECONDS)
+    if run_at < earliest:
+        run_at += timedelta(days=1)
+    return run_at
+
+
+# Add a job. Pass cost for fetch and delete jobs if it's already known, so it doesn't
+# have to be estimated with more queries.
 def add_job(
-    job_type, user_id, funcs, data={}, job_timeout="24h", scheduled_timestamp=None
+    job_type,
+    user_id,
+    funcs,
+    data={},
+    job_timeout="24h",
+    scheduled_timestamp=None,
+    cost=None,
 ):
     if not scheduled_timestamp:
         scheduled_timestamp = datetime.now()
@@ -40,46 +251,132 @@ def add_job(
         f"add_job: job_type={job_type}, user_id={user_id}, data={data}, job_timeout={job_timeout}, scheduled_timestamp={scheduled_timestamp}",
     )
 
-    # Make sure there's not already a scheduled job of this type
-    existing_job_details = db_session.scalar(
-        select(JobDetails)
-        .where(JobDetails.user_id == user_id)
-        .where(JobDetails.job_type == job_type)
-        .where(JobDetails.status == "pending")
-    )
-    if existing_job_details:
+    # Add the job. There's a unique index on (user_id, job_type) for pending and
+    # active jobs, so if this user already has one of these nothing gets inserted.
+    job_details_id = db_session.execute(
+        insert(JobDetails)
+        .values(
+            job_type=job_type,
+            user_id=user_id,
+            status="pending",
+            data=json.dumps(data),
+            scheduled_timestamp=scheduled_timestamp,
+        )
+        .on_conflict_do_nothing(
+            index_elements=["user_id", "job_type"],
+            index_where=JobDetails.status.in_(["pending", "active"]),
+        )
+        .returning(JobDetails.id)
+    ).scalar()
+    db_session.commit()
+
+    if job_details_id is None:
         log(
             None,
-            f"Skipping adding {job_type} job for user_id={user_id}, job is already pending",
+            f"Skipping adding {job_type} job for user_id={user_id}, there's already one pending or active",
         )
         return
 
-    # Add the job
-    job_details = JobDetails(
-        job_type=job_type,
-        user_id=user_id,
-        data=json.dumps(data),
-        scheduled_timestamp=scheduled_timestamp,
-    )
-    db_session.add(job_details)
-    db_session.commit()
+    if JOB_QUEUE_BACKEND == "postgres":
+        return
 
-    redis_job = jobs_q.enqueue_at(
+    # Estimating the cost only needs these, so there's no need to load the job
+    job_details = JobDetails(id=job_details_id, job_type=job_type, user_id=user_id)
+    q, meta = job_queue_and_meta(job_details, cost)
+    redis_job = q.enqueue_at(
         scheduled_timestamp,
         funcs[job_type],
-        job_details.id,
+        job_details_id,
         job_timeout=job_timeout,
+        meta=meta,
         # retry=Retry(max=3, interval=[60, 120, 240]),
     )
 
-    job_details.redis_id = redis_job.id
+    db_session.execute(
+        update(JobDetails)
+        .where(JobDetails.id == job_details_id)
+        .values(redis_id=redis_job.id)
+    )
+    db_session.commit()
+
+
+# Put an existing job back in the queue, to run again later
+def reschedule_job(job_details, funcs, scheduled_timestamp, job_timeout="24h"):
+    log(
+        job_details,
+        f"reschedule_job: job_type={job_details.job_type}, scheduled_timestamp={scheduled_timestamp}",
+    )
+
+    if JOB_QUEUE_BACKEND != "postgres":
+        q, meta = job_queue_and_meta(job_details)
+        redis_job = q.enqueue_at(
+            scheduled_timestamp,
+            funcs[job_details.job_type],
+            job_details.id,
+            job_timeout=job_timeout,
+            meta=meta,
+        )
+        job_details.redis_id = redis_job.id
+
+    job_details.status = "pending"
+    job_details.scheduled_timestamp = scheduled_timestamp
+    db_session.add(job_details)
+    db_session.commit()
+
+
+# DMs to the same user that get queued within this many seconds are sent as one DM
+DM_COALESCE_WINDOW = int(os.environ.get("DM_COALESCE_WINDOW", 600))
+DM_MAX_LENGTH = 10000
+
+
+def _coalesce_dm_key(dest_twitter_id, priority):
+    return f"pending_dm:{priority}:{dest_twitter_id}"
+
+
+def _coalesce_dm(dest_twitter_id, message, priority):
+    """
+    If a DM to this user was queued recently and hasn't been sent yet, add this
+    message to it. Returns True if the message was merged.
+    """
+    job_details_id = conn.get(_coalesce_dm_key(dest_twitter_id, priority))
+    if not job_details_id:
+        return False
+
+    # Lock the row so the DM job can't start, and other messages can't be merged,
+    # until we're done
+    job_details = db_session.scalar(
+        select(JobDetails)
+        .where(JobDetails.id == int(job_details_id))
+        .where(JobDetails.status == "pending")
+        .with_for_update()
+    )
+    if not job_details:
+        db_session.commit()
+        return False
+
+    data = json.loads(job_details.data)
+    combined_message = f"{data['message']}\n\n{message}"
+    if len(combined_message) > DM_MAX_LENGTH:
+        db_session.commit()
+        return False
+
+    data["message"] = combined_message
+    job_details.data = json.dumps(data)
     db_session.add(job_details)
     db_session.commit()
 
+    log(job_details, f"add_dm_job: merged into pending DM to {dest_twitter_id}")
+    return True
+
 
 def add_dm_job(
     funcs, dest_twitter_id, message, scheduled_timestamp=None, priority="high"
 ):
+    # Only DMs that should be sent right away get merged
+    coalesce = scheduled_timestamp is None
+    if coalesce and _coalesce_dm(dest_twitter_id, message, priority):
+        return
+
     if not scheduled_timestamp:
         scheduled_timestamp = datetime.now()
     log(
@@ -90,27 +387,295 @@ def add_dm_job(
     job_details = JobDetails(
         job_type="dm",
         user_id=None,
-        data=json.dumps({"dest_twitter_id": dest_twitter_id, "message": message}),
+        data=json.dumps(
+            {
+                "dest_twitter_id": dest_twitter_id,
+                "message": message,
+                "priority": priority,
+            }
+        ),
         scheduled_timestamp=scheduled_timestamp,
     )
     db_session.add(job_details)
     db_session.commit()
 
-    if priority == "high":
-        q = dm_jobs_high_q
-    else:
-        q = dm_jobs_low_q
-    redis_job = q.enqueue_at(
-        scheduled_timestamp,
-        funcs["dm"],
-        job_details.id,
-        job_timeout="10m",
-        # retry=Retry(max=3, interval=[60, 120, 240]),
+    if JOB_QUEUE_BACKEND != "postgres":
+        if priority == "high":
+            q = dm_jobs_high_q
+        else:
+            q = dm_jobs_low_q
+        redis_job = q.enqueue_at(
+            scheduled_timestamp,
+            funcs["dm"],
+            job_details.id,
+            job_timeout="10m",
+            # retry=Retry(max=3, interval=[60, 120, 240]),
+        )
+
+        job_details.redis_id = redis_job.id
+        db_session.add(job_details)
+        db_session.commit()
+
+    if coalesce:
+        conn.set(
+            _coalesce_dm_key(dest_twitter_id, priority),
+            job_details.id,
+            ex=DM_COALESCE_WINDOW,
+        )
+
+
+class RetryLater(Exception):
+    """
+    Raised while a job is running to stop it, and run it again at retry_at (a unix
+    timestamp) instead of keeping a worker busy while it waits
+    """
+
+    def __init__(self, retry_at, reason):
+        self.retry_at = retry_at
+        self.reason = reason
+        super().__init__(reason)
+
+
+# Jobs wait this long at most, anything longer and they get rescheduled instead
+RETRY_LATER_AFTER = int(os.environ.get("RETRY_LATER_AFTER", 30))
+
+_retry_later_enabled = False
+
+
+@contextmanager
+def retry_later_on_waits():
+    """
+    Inside this, long waits raise RetryLater instead of sleeping. Jobs that can pick
+    up where they left off run inside it.
+    """
+    global _retry_later_enabled
+    _retry_later_enabled = True
+    try:
+        yield
+    finally:
+        _retry_later_enabled = False
+
+
+def should_retry_later(seconds):
+    """
+    Whether a job should stop and run again later instead of waiting this long
+    """
+    return _retry_later_enabled and seconds > RETRY_LATER_AFTER
+
+
+def wait_or_retry_later(seconds, reason):
+    if should_retry_later(seconds):
+        raise RetryLater(time.time() + seconds, reason)
+    time.sleep(seconds)
+
+
+# Rate limit ledger, shared by every process. Twitter's rate limits are per app, access
+# token and endpoint, and every response says how many calls are left and when the
+# limit resets. Before making a call, a process reserves one of the remaining calls,
+# and if there aren't any left it waits for the reset instead of getting a 429.
+
+RATE_LIMITS_KEY = "rate_limits"
+
+_reserve_call = conn.register_script(
+    """
+local bucket = redis.call("HMGET", KEYS[1], "remaining", "reset")
+local remaining = tonumber(bucket[1])
+local reset = tonumber(bucket[2])
+local now = tonumber(ARGV[1])
+
+if remaining == nil or reset == nil or reset <= now then
+    return "0"
+end
+if remaining > 0 then
+    redis.call("HINCRBY", KEYS[1], "remaining", -1)
+    return "0"
+end
+return tostring(reset - now)
+"""
+)
+
+
+def rate_limit_token(consumer_key, access_token):
+    """
+    What the ledger calls an app and access token, without storing the token itself
+    """
+    return hashlib.sha256(f"{consumer_key}:{access_token}".encode()).hexdigest()[:16]
+
+
+def rate_limit_label(access_token):
+    if access_token == os.environ.get("TWITTER_SEMIPHEMERAL_ACCESS_TOKEN"):
+        return "@semiphemeral"
+    return "user"
+
+
+def _rate_limit_key(token, endpoint):
+    return f"rate_limit:{token}:{endpoint}"
+
+
+def rate_limit_endpoint(url):
+    """
+    Turn a request url into the endpoint its rate limit is for, like
+    /1.1/statuses/destroy/:id.json
+    """
+    path = url.split("://", 1)[-1].split("?", 1)[0]
+    path = path[path.find("/") :]
+    return re.sub(r"(?<=.)/\d+(?=/|\.json|$)", "/:id", path)
+
+
+def rate_limit_wait(token, endpoint):
+    """
+    Reserve a call, and return 0 if it's okay to make it, or else how many seconds
+    until the limit resets
+    """
+    return float(
+        _reserve_call(keys=[_rate_limit_key(token, endpoint)], args=[time.time()])
     )
 
-    job_details.redis_id = redis_job.id
-    db_session.add(job_details)
-    db_session.commit()
+
+def record_rate_limit(token, label, endpoint, response):
+    """
+    Save the rate limit headers from a twitter response
+    """
+    remaining = response.headers.get("x-rate-limit-remaining")
+    reset = response.headers.get("x-rate-limit-reset")
+    if remaining is None or reset is None:
+        return
+
+    key = _rate_limit_key(token, endpoint)
+    expire_at = int(reset) + 60
+    pipe = conn.pipeline()
+    pipe.hset(
+        key,
+        mapping={
+            "label": label,
+            "endpoint": endpoint,
+            "limit": response.headers.get("x-rate-limit-limit", remaining),
+            "remaining": remaining,
+            "reset": reset,
+        },
+    )
+    pipe.expireat(key, expire_at)
+    pipe.zadd(RATE_LIMITS_KEY, {key: expire_at})
+    pipe.execute()
+
+
+def rate_limit_status(limit=None):
+    """
+    Every token and endpoint in the ledger, starting with the ones with the least
+    headroom
+    """
+    conn.zremrangebyscore(RATE_LIMITS_KEY, "-inf", time.time())
+    keys = conn.zrange(RATE_LIMITS_KEY, 0, -1)
+    pipe = conn.pipeline()
+    for key in keys:
+        pipe.hgetall(key)
+
+    status = []
+    for bucket in pipe.execute():
+        if not bucket:
+            continue
+        bucket = {k.decode(): v.decode() for k, v in bucket.items()}
+        status.append(
+            {
+                "label": bucket["label"],
+                "endpoint": bucket["endpoint"],
+                "limit": int(bucket["limit"]),
+                "remaining": int(bucket["remaining"]),
+                "reset": int(bucket["reset"]),
+            }
+        )
+    status.sort(key=lambda b: b["remaining"] / max(b["limit"], 1))
+    if limit:
+        status = status[:limit]
+    return status
+
+
+class RateLimitedSession(requests.Session):
+    """
+    requests session for tweepy that checks the rate limit ledger before each call,
+    and updates it from each response
+    """
+
+    def __init__(self, consumer_key, access_token):
+        super().__init__()
+        self.token = rate_limit_token(consumer_key, access_token)
+        self.label = rate_limit_label(access_token)
+
+    def request(self, method, url, *args, **kwargs):
+        endpoint = rate_limit_endpoint(url)
+        try:
+            while True:
+                wait = rate_limit_wait(self.token, endpoint)
+                if wait <= 0:
+                    break
+                log(
+                    None,
+                    f"Rate limit ledger: no calls left for {self.label} on {endpoint}, waiting {wait:.0f}s",
+                )
+                wait_or_retry_later(wait + 1, f"Rate limited on {endpoint}")
+        except redis.exceptions.RedisError as e:
+            log(None, f"Rate limit ledger: {e}")
+
+        response = super().request(method, url, *args, **kwargs)
+
+        try:
+            record_rate_limit(self.token, self.label, endpoint, response)
+        except redis.exceptions.RedisError as e:
+            log(None, f"Rate limit ledger: {e}")
+
+        # tweepy would sleep until the reset, so jobs stop before it gets the chance
+        if response.status_code == 429 and _retry_later_enabled:
+            reset = response.headers.get("x-rate-limit-reset")
+            retry_at = int(reset) + 1 if reset else time.time() + 60
+            raise RetryLater(retry_at, f"Rate limited on {endpoint}")
+        return response
+
+
+# Pool of tweepy API and Client objects. Each one has its own requests session, so
+# reusing them for the same app and access token keeps connections to twitter open
+# between calls instead of doing a new TLS handshake every time.
+
+TWITTER_CLIENT_POOL_SIZE = int(os.environ.get("TWITTER_CLIENT_POOL_SIZE", 256))
+
+
+class TwitterClientPool:
+    """
+    LRU cache of tweepy clients, which closes the sessions of clients it evicts
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.clients = OrderedDict()
+        self.pid = os.getpid()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, create):
+        # Forked processes shouldn't share connections with their parent
+        if os.getpid() != self.pid:
+            self.clients = OrderedDict()
+            self.pid = os.getpid()
+
+        if key in self.clients:
+            self.clients.move_to_end(key)
+            self.hits += 1
+            return self.clients[key]
+
+        self.misses += 1
+        client = create()
+        self.clients[key] = client
+        while len(self.clients) > self.max_size:
+            _, evicted = self.clients.popitem(last=False)
+            evicted.session.close()
+        return client
+
+    def clear(self):
+        for client in self.clients.values():
+            client.session.close()
+        self.clients.clear()
+
+
+twitter_client_pool = TwitterClientPool(TWITTER_CLIENT_POOL_SIZE)
 
 
 # Twitter API v2
@@ -123,13 +688,21 @@ def create_tweepy_client(
     access_token_secret,
     wait_on_rate_limit=True,
 ):
-    return tweepy.Client(
-        consumer_key=consumer_key,
-        consumer_secret=consumer_secret,
-        access_token=access_token,
-        access_token_secret=access_token_secret,
-        return_type=dict,
-        wait_on_rate_limit=wait_on_rate_limit,
+    def create():
+        client = tweepy.Client(
+            consumer_key=consumer_key,
+            consumer_secret=consumer_secret,
+            access_token=access_token,
+            access_token_secret=access_token_secret,
+            return_type=dict,
+            wait_on_rate_limit=wait_on_rate_limit,
+        )
+        client.session = RateLimitedSession(consumer_key, access_token)
+        return client
+
+    return twitter_client_pool.get(
+        ("v2", consumer_key, access_token, access_token_secret, wait_on_rate_limit),
+        create,
     )
 
 
@@ -167,13 +740,35 @@ def tweepy_semiphemeral_client():
 # Twitter API v1.1
 
 
+class RetryLaterAPI(tweepy.API):
+    """
+    tweepy.API turns any exception from its session into a TweepyException, so this
+    raises RetryLater from the session again as itself
+    """
+
+    def request(self, *args, **kwargs):
+        try:
+            return super().request(*args, **kwargs)
+        except tweepy.errors.TweepyException as e:
+            if isinstance(e.__context__, RetryLater):
+                raise e.__context__
+            raise
+
+
 def create_tweepy_api_1_1(
     consumer_key, consumer_secret, access_token, access_token_secret
 ):
-    auth = tweepy.OAuth1UserHandler(
-        consumer_key, consumer_secret, access_token, access_token_secret
+    def create():
+        auth = tweepy.OAuth1UserHandler(
+            consumer_key, consumer_secret, access_token, access_token_secret
+        )
+        api = RetryLaterAPI(auth, wait_on_rate_limit=True)
+        api.session = RateLimitedSession(consumer_key, access_token)
+        return api
+
+    return twitter_client_pool.get(
+        ("v1.1", consumer_key, access_token, access_token_secret), create
     )
-    return tweepy.API(auth, wait_on_rate_limit=True)
 
 
 def tweepy_semiphemeral_api_1_1():
@@ -206,13 +801,159 @@ def tweepy_dms_api_v1_1(user):
     )
 
 
+# Admin notifications wait here until admin_notifier.py sends them to the webhook
+ADMIN_NOTIFICATIONS_KEY = "admin_notifications"
+
+
 def send_admin_notification(message):
-    # Webhook
-    webhook_url = os.environ.get("ADMIN_WEBHOOK")
+    """
+    Queue a message for the admin webhook, without waiting for it to get sent
+    """
+    if not os.environ.get("ADMIN_WEBHOOK"):
+        return
+    conn.lpush(ADMIN_NOTIFICATIONS_KEY, message)
+
+
+# Cache of verify_credentials results, so checking that a user's creds still work
+# doesn't need a round trip to twitter every time
+
+CREDS_CACHE_TTL = int(os.environ.get("CREDS_CACHE_TTL", 600))
+
+
+def _creds_cache_key(user_id, dms):
+    return f"creds:{'dms' if dms else 'main'}:{user_id}"
+
+
+def cache_creds_status(user_id, response, dms=False):
+    """
+    Save the result of a successful verify_credentials call
+    """
+    conn.set(
+        _creds_cache_key(user_id, dms),
+        json.dumps(
+            {"valid": True, "profile_image_url": response.profile_image_url_https}
+        ),
+        ex=CREDS_CACHE_TTL,
+    )
+
+
+def get_creds_status(user, dms=False):
+    """
+    Returns a dict with "valid", which is False if twitter says the user's creds are
+    unauthorized, and "profile_image_url". Other errors from twitter are raised, and
+    aren't cached.
+    """
+    status = conn.get(_creds_cache_key(user.id, dms))
+    if status:
+        return json.loads(status)
+
+    api = tweepy_dms_api_v1_1(user) if dms else tweepy_api_v1_1(user)
     try:
-        requests.post(webhook_url, data=message)
-    except:
-        pass
+        response = api.verify_credentials()
+    except tweepy.errors.Unauthorized:
+        status = {"valid": False, "profile_image_url": None}
+        conn.set(_creds_cache_key(user.id, dms), json.dumps(status), ex=CREDS_CACHE_TTL)
+        return status
+
+    cache_creds_status(user.id, response, dms)
+    return {"valid": True, "profile_image_url": response.profile_image_url_https}
+
+
+def invalidate_creds_status(user_id):
+    conn.delete(_creds_cache_key(user_id, False), _creds_cache_key(user_id, True))
+
+
+# Jobs publish their progress as it changes, so dashboards can show it live instead
+# of polling. Channels are per twitter_id, which the web app can get straight from
+# the flask session.
+
+
+def job_progress_channel(twitter_id):
+    return f"job_progress:{twitter_id}"
+
+
+def publish_job_progress(twitter_id, job_details, data):
+    conn.publish(
+        job_progress_channel(twitter_id),
+        json.dumps(
+            {
+                "id": job_details.id,
+                "job_type": job_details.job_type,
+                "status": job_details.status,
+                "progress": data.get("progress", {}),
+            }
+        ),
+    )
+
+
+# Blocked users see the fascist tweets they liked on their dashboard. The tweets get
+# cached so the dashboard doesn't need to look them up on twitter every time it loads.
+# Likes older than 6 months don't count, so the cache doesn't need to last longer.
+FASCIST_TWEET_CACHE_TTL = 60 * 60 * 24 * 190
+
+# Tweets that twitter doesn't return (deleted, or from protected accounts) are only
+# cached for a day, in case they come back
+MISSING_FASCIST_TWEET_CACHE_TTL = 60 * 60 * 24
+
+# lookup_statuses takes at most 100 ids
+LOOKUP_STATUSES_BATCH_SIZE = 100
+
+
+def _fascist_tweet_key(twitter_id):
+    return f"fascist_tweet:{twitter_id}"
+
+
+def get_fascist_tweets(twitter_ids, api=None):
+    """
+    Returns a dict mapping tweet ids to each tweet's "text", "created_at", "name", and
+    "username". Tweets that aren't cached get looked up in bulk using the
+    @semiphemeral API, so we don't need the creds of the user who liked them.
+    """
+    twitter_ids = list(dict.fromkeys(str(twitter_id) for twitter_id in twitter_ids))
+    if not twitter_ids:
+        return {}
+
+    tweets = {}
+    missing_ids = []
+    cached = conn.mget([_fascist_tweet_key(twitter_id) for twitter_id in twitter_ids])
+    for twitter_id, tweet in zip(twitter_ids, cached):
+        if tweet:
+            tweets[twitter_id] = json.loads(tweet)
+        else:
+            missing_ids.append(twitter_id)
+
+    if missing_ids:
+        if not api:
+            api = tweepy_semiphemeral_api_1_1()
+
+        for i in range(0, len(missing_ids), LOOKUP_STATUSES_BATCH_SIZE):
+            batch = missing_ids[i : i + LOOKUP_STATUSES_BATCH_SIZE]
+            statuses = {
+                status.id_str: status for status in api.lookup_statuses(batch)
+            }
+
+            with conn.pipeline() as pipeline:
+                for twitter_id in batch:
+                    status = statuses.get(twitter_id)
+                    if status:
+                        tweet = {
+                            "text": status.text,
+                            "created_at": status.created_at.timestamp(),
+                            "name": status.author.name,
+                            "username": status.author.screen_name,
+                        }
+                        ttl = FASCIST_TWEET_CACHE_TTL
+                    else:
+                        tweet = {"text": "", "created_at": 0, "name": "", "username": ""}
+                        ttl = MISSING_FASCIST_TWEET_CACHE_TTL
+
+                    tweets[twitter_id] = tweet
+                    pipeline.set(
+                        _fascist_tweet_key(twitter_id), json.dumps(tweet), ex=ttl
+                    )
+                pipeline.execute()
+
+    return tweets
 
 
 def delete_user(user):
@@ -224,5 +965,48 @@ def delete_user(user):
     db_session.execute(delete(Thread).where(Thread.user_id == user.id))
     db_session.commit()
 
+    invalidate_creds_status(user.id)
     db_session.delete(user)
     db_session.commit()
+
+
+# After a delete job finishes, the next one only needs to look at what changed since
+# then. This keeps track of when that was, and gets cleared whenever the user changes
+# something that could make older tweets deletable.
+DELETE_PLAN_TTL = 60 * 60 * 24 * 14
+
+# Even if nothing seems to have changed, look through everything this often
+FULL_SCAN_INTERVAL = timedelta(days=7)
+
+
+def _delete_plan_key(user_id):
+    return f"delete_plan:{user_id}"
+
+
+def get_delete_plan(user_id):
+    plan = conn.get(_delete_plan_key(user_id))
+    if plan:
+        return json.loads(plan)
+    return None
+
+
+def save_delete_plan(user_id, plan):
+    conn.set(_delete_plan_key(user_id), json.dumps(plan), ex=DELETE_PLAN_TTL)
+
+
+def invalidate_delete_plan(user_id):
+    conn.delete(_delete_plan_key(user_id))
+
+
+def incremental_delete_cost(plan, run_at):
+    """
+    If a delete job running at run_at (a timestamp) will only look at what changed,
+    the cost the last run saved in the plan, otherwise None
+    """
+    if (
+        plan
+        and "cost" in plan
+        and run_at - plan["full_scan"] < FULL_SCAN_INTERVAL.total_seconds()
+    ):
+        return plan["cost"]
+    return None
@@ -97,12 +97,13 @@ class JobDetails(Base):
     )  # "fetch", "delete", "delete_dms", "delete_dm_groups", "dm", "block", "unblock"
     status = Column(
         String, default="pending"
-    )  # "pending", "active", "finished", "canceled"
+    )  # "pending", "active", "finished", "canceled", "failed"
     data = Column(String, default="{}")  # JSON object
     redis_id = Column(String)
     scheduled_timestamp = Column(DateTime)
     started_timestamp = Column(DateTime)
     finished_timestamp = Column(DateTime)
+    attempts = Column(Integer, default=0)  # failed tries, with the postgres job queue
 
     def __str__(self):
         return (
@@ -110,6 +111,17 @@ class JobDetails(Base):
         )
 
 
+class StripeEvent(Base):
+    __tablename__ = "stripe_events"
+
+    id = Column(String, primary_key=True)  # Stripe's event id
+    event_type = Column(String)
+    payload = Column(String)  # JSON object
+    status = Column(String, default="pending")  # "pending", "processed"
+    received_timestamp = Column(DateTime)
+    processed_timestamp = Column(DateTime)
+
+
 class DirectMessageJob(Base):
     __tablename__ = "direct_message_jobs"
 
@@ -0,0 +1,137 @@
+import os
+import time
+
+from rq import Worker
+from sqlalchemy import select, func, cast, case
+from sqlalchemy.dialects.postgresql import JSONB
+from db import JobDetails, session as db_session
+
+from common import (
+    log,
+    conn as redis_conn,
+    dm_jobs_high_q,
+    dm_jobs_low_q,
+    JOB_QUEUE_BACKEND,
+)
+
+# The global rate that DMs get sent from @semiphemeral, shared by every DM worker
+DM_RATE_PER_HOUR = int(os.environ.get("DM_RATE_PER_HOUR", 40))
+DM_BURST = int(os.environ.get("DM_BURST", 5))
+
+# Token bucket, stored in redis so it's shared between processes. Returns how many
+# seconds to wait before trying again, or 0 if a token was taken.
+_take_token = redis_conn.register_script(
+    """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "timestamp")
+local tokens = tonumber(bucket[1])
+local timestamp = tonumber(bucket[2])
+if tokens == nil then
+    tokens = capacity
+    timestamp = now
+end
+
+tokens = math.min(capacity, tokens + math.max(0, now - timestamp) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+
+redis.call("HSET", KEYS[1], "tokens", tokens, "timestamp", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+)
+
+
+def seconds_per_dm():
+    return 3600 / DM_RATE_PER_HOUR
+
+
+def wait_for_send_slot(worker=None):
+    """
+    Block until the global DM rate limit allows sending another DM
+    """
+    while True:
+        wait = float(
+            _take_token(
+                keys=["dm_dispatcher:bucket"],
+                args=[DM_RATE_PER_HOUR / 3600, DM_BURST, time.time()],
+            )
+        )
+        if wait <= 0:
+            return
+
+        log(None, f"DM dispatcher: waiting {wait:.1f}s for a send slot")
+        time.sleep(wait)
+        if worker:
+            worker.heartbeat()
+
+
+def _queue_counts():
+    """
+    How many DMs are ready to send and how many are scheduled for later, for each
+    priority
+    """
+    if JOB_QUEUE_BACKEND != "postgres":
+        return {
+            "high": (dm_jobs_high_q.count, dm_jobs_high_q.scheduled_job_registry.count),
+            "low": (dm_jobs_low_q.count, dm_jobs_low_q.scheduled_job_registry.count),
+        }
+
+    # With the postgres job queue, DMs wait as pending dm jobs instead
+    priority = func.coalesce(cast(JobDetails.data, JSONB)["priority"].astext, "high")
+    scheduled = case(
+        (JobDetails.scheduled_timestamp > func.now(), True),
+        else_=False,
+    )
+    counts = {"high": [0, 0], "low": [0, 0]}
+    for job_priority, is_scheduled, count in db_session.execute(
+        select(priority, scheduled, func.count())
+        .where(JobDetails.job_type == "dm")
+        .where(JobDetails.status == "pending")
+        .group_by(priority, scheduled)
+    ):
+        key = "low" if job_priority == "low" else "high"
+        counts[key][1 if is_scheduled else 0] += count
+    return {key: tuple(value) for key, value in counts.items()}
+
+
+def queue_status():
+    """
+    Depth of the DM queues, and roughly how many seconds until a DM that gets queued
+    now will be sent
+    """
+    counts = _queue_counts()
+    high, high_scheduled = counts["high"]
+    low, low_scheduled = counts["low"]
+    return {
+        "rate_per_hour": DM_RATE_PER_HOUR,
+        "high": {
+            "depth": high,
+            "scheduled": high_scheduled,
+            "eta": int(high * seconds_per_dm()),
+        },
+        "low": {
+            "depth": low,
+            "scheduled": low_scheduled,
+            "eta": int((high + low) * seconds_per_dm()),
+        },
+    }
+
+
+class DMDispatcher(Worker):
+    """
+    A worker for the DM queues that paces jobs using the global token bucket, instead
+    of each DM job sleeping after it sends. Queues are listened to in order, so
+    dm_jobs_high is always drained before dm_jobs_low.
+    """
+
+    def execute_job(self, job, queue):
+        wait_for_send_slot(self)
+        return super().execute_job(job, queue)
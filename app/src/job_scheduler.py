@@ -0,0 +1,86 @@
+import os
+import time
+
+from rq import Worker
+
+from common import conn as redis_conn, job_class_queues
+
+# When every class has jobs waiting, each class gets worker time in proportion to its
+# weight. Cost is measured in how many tweets and likes a job goes through.
+JOB_CLASS_WEIGHTS = {
+    "short": int(os.environ.get("JOB_WEIGHT_SHORT", 6)),
+    "long": int(os.environ.get("JOB_WEIGHT_LONG", 3)),
+    "bulk_dms": int(os.environ.get("JOB_WEIGHT_BULK_DMS", 1)),
+}
+
+# How far back the cost of started jobs counts against their class
+WINDOW_MINUTES = 60
+
+_queue_classes = {q.name: job_class for job_class, q in job_class_queues.items()}
+
+
+def _bucket_key(minute):
+    return f"job_scheduler:served:{minute}"
+
+
+def charge(job_class, cost):
+    """
+    Count the cost of a job that's starting against its class, for every worker
+    """
+    key = _bucket_key(int(time.time() // 60))
+    pipe = redis_conn.pipeline()
+    pipe.hincrbyfloat(key, job_class, cost)
+    pipe.expire(key, (WINDOW_MINUTES + 1) * 60)
+    pipe.execute()
+
+
+def served():
+    """
+    Total cost of the jobs each class started within the window
+    """
+    now = int(time.time() // 60)
+    pipe = redis_conn.pipeline()
+    for minute in range(now - WINDOW_MINUTES + 1, now + 1):
+        pipe.hgetall(_bucket_key(minute))
+
+    totals = {job_class: 0.0 for job_class in JOB_CLASS_WEIGHTS}
+    for bucket in pipe.execute():
+        for job_class, cost in bucket.items():
+            job_class = job_class.decode()
+            if job_class in totals:
+                totals[job_class] += float(cost)
+    return totals
+
+
+def order_queues(queues):
+    """
+    Put the queue of the class that has gotten the least of its share first. rq
+    takes jobs from the first queue that has any, so a class that isn't busy doesn't
+    hold the others back.
+    """
+    totals = served()
+
+    def share(q):
+        job_class = _queue_classes[q.name]
+        return totals[job_class] / JOB_CLASS_WEIGHTS[job_class]
+
+    # sorted() is stable, so ties go to the queue that was listed first
+    return sorted(queues, key=share)
+
+
+class WeightedWorker(Worker):
+    """
+    A worker for several job class queues that picks which queue to take from next
+    based on each class's weight and the cost of the jobs it has already started
+    """
+
+    def dequeue_job_and_maintain_ttl(self, timeout):
+        if len(self.queues) > 1:
+            self._ordered_queues = order_queues(self.queues)
+        return super().dequeue_job_and_maintain_ttl(timeout)
+
+    def execute_job(self, job, queue):
+        job_class = job.meta.get("job_class", _queue_classes.get(queue.name))
+        if job_class:
+            charge(job_class, job.meta.get("cost", 1))
+        return super().execute_job(job, queue)
@@ -2,6 +2,7 @@ import json
 import os
 from datetime import datetime, timedelta
 import time
+import asyncio
 
 import tweepy
 
@@ -12,6 +13,8 @@ from db import (
     JobDetails,
     User,
     Tip,
+    RecurringTip,
+    StripeEvent,
     Nag,
     Tweet,
     Thread,
@@ -23,6 +26,7 @@ from db import (
 
 from common import (
     log,
+    send_admin_notification,
     tweepy_client,
     tweepy_semiphemeral_client,
     tweepy_api_v1_1,
@@ -30,13 +34,71 @@ from common import (
     tweepy_semiphemeral_api_1_1,
     add_job,
     add_dm_job,
+    reschedule_job,
+    next_daily_run,
+    get_delete_plan,
+    get_creds_status,
+    invalidate_creds_status,
+    RetryLater,
+    retry_later_on_waits,
+    wait_or_retry_later,
+    save_delete_plan,
+    incremental_delete_cost,
+    FULL_SCAN_INTERVAL,
+    get_fascist_tweets,
+    publish_job_progress,
 )
+import dm_dispatcher
+import twitter_async
+from twitter_async import async_api_v1_1, ASYNC_TWITTER_CONCURRENCY
 
 
 class JobCanceled(Exception):
     pass
 
 
+# Progress gets published to the dashboard every time it changes, but only saved to
+# the database this often
+PROGRESS_SAVE_INTERVAL = int(os.environ.get("PROGRESS_SAVE_INTERVAL", 30))
+
+
+class JobProgress:
+    """
+    Publishes a job's progress every time it's updated, and saves it, along with
+    anything else in the database session, every PROGRESS_SAVE_INTERVAL seconds. As
+    a context manager it saves whatever is left at the end, including when the job
+    stops to run again later.
+    """
+
+    def __init__(self, job_details, user, data):
+        self.job_details = job_details
+        self.twitter_id = user.twitter_id
+        self.data = data
+        self.last_saved = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None or issubclass(exc_type, RetryLater):
+            self.save()
+
+    def publish(self):
+        publish_job_progress(self.twitter_id, self.job_details, self.data)
+
+    def update(self):
+        self.publish()
+        if time.monotonic() - self.last_saved >= PROGRESS_SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        self.job_details.data = json.dumps(self.data)
+        db_session.add(self.job_details)
+        db_session.commit()
+        self.last_saved = time.monotonic()
+        self.publish()
+
+
 # Exception helpers
 
 
@@ -51,14 +113,17 @@ def handle_tweepy_rate_limit(job_details, e, api_endpoint):
     if sleep_time > 0:
         log(
             job_details,
-            f"Rate limit on {api_endpoint}, sleeping {sleep_time}s",
+            f"Rate limit on {api_endpoint}, waiting {sleep_time}s",
         )
-        time.sleep(sleep_time + 1)  # sleep for extra sec
+        # wait for an extra sec
+        wait_or_retry_later(sleep_time + 1, f"Rate limited on {api_endpoint}")
 
 
 def handle_tweepy_exception(job_details, e, api_endpoint):
-    log(job_details, f"Error on {api_endpoint}, sleeping 120s: {e}")
-    time.sleep(120)
+    if isinstance(e, RetryLater):
+        raise e
+    log(job_details, f"Error on {api_endpoint}, waiting 120s: {e}")
+    wait_or_retry_later(120, f"Error on {api_endpoint}")
 
 
 # Decorators
@@ -75,10 +140,7 @@ def test_api_creds(func):
         disconnect = job_details.job_type == "fetch"
         user = db_session.scalar(select(User).where(User.id == job_details.user_id))
         if user:
-            api = tweepy_api_v1_1(user)
-            try:
-                api.verify_credentials()
-            except tweepy.errors.Unauthorized:
+            if not get_creds_status(user)["valid"]:
                 print(
                     f"user_id={user.id} API creds failed, canceling job and pausing user"
                 )
@@ -103,7 +165,26 @@ def test_api_creds(func):
                 db_session.close()
             return False
 
-        return func(user, job_details_id, funcs)
+        user_id = user.id
+        try:
+            with retry_later_on_waits():
+                return func(user, job_details_id, funcs)
+        except tweepy.errors.Unauthorized:
+            # The creds stopped working, so make sure they get checked next time
+            invalidate_creds_status(user_id)
+            raise
+        except RetryLater as e:
+            # Free up the worker. The job saved a checkpoint, so when it runs again it
+            # picks up where it left off.
+            db_session.rollback()
+            job_details = db_session.scalar(
+                select(JobDetails).where(JobDetails.id == job_details_id)
+            )
+            retry_at = datetime.fromtimestamp(e.retry_at)
+            log(job_details, f"{e.reason}, running again at {retry_at}")
+            reschedule_job(job_details, funcs, retry_at)
+            db_session.close()
+            return False
 
     return wrapper
 
@@ -126,22 +207,8 @@ def validate_job(func):
                 db_session.close()
             return False
 
-        # Make sure this isn't a duplicate job
-        duplicate_jobs = db_session.scalars(
-            select(JobDetails)
-            .where(JobDetails.user_id == job_details.user_id)
-            .where(JobDetails.job_type == job_details.job_type)
-            .where(or_(JobDetails.status == "pending", JobDetails.status == "active"))
-            .where(JobDetails.id != job_details_id)
-        ).fetchall()
-        if len(duplicate_jobs) > 0:
-            job_details.status = "canceled"
-            db_session.add(job_details)
-            db_session.commit()
-            log(job_details, "Duplicate job, quitting early")
-            if disconnect:
-                db_session.close()
-            return False
+        # There's no need to check for duplicate jobs, the database doesn't allow a
+        # user to have more than one pending or active job of each type
 
         return func(job_details, user, funcs)
 
@@ -151,9 +218,12 @@ def validate_job(func):
 # Fetch job
 
 
-@test_api_creds
-@validate_job
-def fetch(job_details, user, funcs):
+def _fetch(job_details, user, funcs):
+    """
+    Fetch new tweets and likes, and update which threads are excluded from deletion.
+    Returns False if the job should stop, or else the twitter ids of the tweets and
+    likes that were fetched and the ids of the threads whose should_exclude changed.
+    """
     disconnect = job_details.job_type == "fetch"
 
     job_details.status = "active"
@@ -168,8 +238,16 @@ def fetch(job_details, user, funcs):
 
     log(job_details, "Fetch started")
 
-    # Start the data
-    data = {"progress": {"tweets_fetched": 0, "likes_fetched": 0}}
+    # Start the data, unless this job already started and had to stop and wait, in
+    # which case pick up from its checkpoint
+    data = json.loads(job_details.data) if job_details.data else {}
+    checkpoint = data.get("checkpoint", {})
+    resumed = checkpoint.get("stage") in ["tweets", "likes"]
+    if not resumed:
+        checkpoint = {"stage": "tweets"}
+        data = {"progress": {"tweets_fetched": 0, "likes_fetched": 0}}
+    data["checkpoint"] = checkpoint
+
     if since_id:
         data["progress"]["status"] = "Downloading all recent tweets"
     else:
@@ -178,19 +256,24 @@ def fetch(job_details, user, funcs):
         ] = "Downloading all tweets, this first run may take a long time"
         log(job_details, "since_id is None, so downloading everything")
 
-    job_details.data = json.dumps(data)
-    db_session.add(job_details)
-    db_session.commit()
+    progress = JobProgress(job_details, user, data)
+    progress.save()
 
     # In API v1.1 we don't get conversation_id, so we have to make a zillion requests to figure it out ourselves.
     # This dict helps to cache that so we can avoid requests. Each item is a tuple (id, in_reply_to_id)
     cache = {}
 
+    changes = {"tweet_ids": set(), "like_ids": set(), "thread_ids": set()}
+
     # Fetch tweets
-    while True:
+    while data["checkpoint"]["stage"] == "tweets":
         try:
             for page in tweepy.Cursor(
-                api.user_timeline, user_id=user.twitter_id, count=200, since_id=since_id
+                api.user_timeline,
+                user_id=user.twitter_id,
+                count=200,
+                since_id=since_id,
+                max_id=data["checkpoint"].get("max_id"),
             ).pages():
                 log(job_details, f"Importing {len(page)} tweets")
                 for status in page:
@@ -207,6 +290,8 @@ def fetch(job_details, user, funcs):
                                     _id = response.id_str
                                     _in_reply_to_id = response.in_reply_to_status_id_str
                                     cache[in_reply_to_id] = (_id, _in_reply_to_id)
+                                except RetryLater:
+                                    raise
                                 except:
                                     break
 
@@ -273,10 +358,14 @@ def fetch(job_details, user, funcs):
 
                     db_session.add(tweet)
                     data["progress"]["tweets_fetched"] += 1
-
-                job_details.data = json.dumps(data)
-                db_session.add(job_details)
-                db_session.commit()
+                    changes["tweet_ids"].add(status.id_str)
+
+                # Pages go from newest to oldest
+                data["checkpoint"] = {
+                    "stage": "tweets",
+                    "max_id": str(int(page[-1].id_str) - 1),
+                }
+                progress.save()
             break
         except tweepy.errors.Forbidden as e:
             log(job_details, f"Forbidden error, pausing user and canceling job: {e}")
@@ -290,6 +379,8 @@ def fetch(job_details, user, funcs):
             handle_tweepy_exception(job_details, e, "api.user_timeline")
 
     # Update progress
+    if data["checkpoint"]["stage"] == "tweets":
+        data["checkpoint"] = {"stage": "likes"}
     if since_id:
         data["progress"]["status"] = "Downloading all recent likes"
     else:
@@ -304,7 +395,11 @@ def fetch(job_details, user, funcs):
     while True:
         try:
             for page in tweepy.Cursor(
-                api.get_favorites, user_id=user.twitter_id, count=200, since_id=since_id
+                api.get_favorites,
+                user_id=user.twitter_id,
+                count=200,
+                since_id=since_id,
+                max_id=data["checkpoint"].get("max_id"),
             ).pages():
                 log(job_details, f"Importing {len(page)} likes")
                 for status in page:
@@ -332,12 +427,15 @@ def fetch(job_details, user, funcs):
                             is_fascist=is_fascist,
                         )
                         db_session.add(like)
+                        changes["like_ids"].add(status.id_str)
 
                     data["progress"]["likes_fetched"] += 1
 
-                job_details.data = json.dumps(data)
-                db_session.add(job_details)
-                db_session.commit()
+                data["checkpoint"] = {
+                    "stage": "likes",
+                    "max_id": str(int(page[-1].id_str) - 1),
+                }
+                progress.save()
 
             break
         except tweepy.errors.TwitterServerError as e:
@@ -360,43 +458,60 @@ def fetch(job_details, user, funcs):
     # and which threads should have their tweets deleted
 
     # Calculate which threads should be excluded from deletion
+    del data["checkpoint"]
     data["progress"]["status"] = "Calculating which threads to exclude from deletion"
     job_details.data = json.dumps(data)
     db_session.add(job_details)
     db_session.commit()
 
-    # Reset the should_exclude flag for all threads
+    # Figure out which threads should be excluded based on the settings
+    excluded_thread_ids = set(
+        db_session.scalars(
+            select(Thread.id)
+            .where(Thread.user_id == user.id)
+            .where(Thread.should_exclude == True)
+        ).all()
+    )
+    should_exclude_thread_ids = set()
+    if user.tweets_threads_threshold:
+        should_exclude_thread_ids = set(
+            db_session.scalars(
+                select(Thread.id)
+                .join(Thread.tweets)
+                .where(Thread.id == Tweet.thread_id)
+                .where(Thread.user_id == user.id)
+                .where(Tweet.user_id == user.id)
+                .where(Tweet.is_deleted == False)
+                .where(Tweet.is_retweet == False)
+                .where(Tweet.retweet_count >= user.tweets_retweet_threshold)
+                .where(Tweet.like_count >= user.tweets_like_threshold)
+            ).all()
+        )
+
+    # Only update the threads that changed
+    unexclude_thread_ids = excluded_thread_ids - should_exclude_thread_ids
+    exclude_thread_ids = should_exclude_thread_ids - excluded_thread_ids
+    changes["thread_ids"] = unexclude_thread_ids | exclude_thread_ids
     while True:
         try:
-            db_session.execute(
-                update(Thread)
-                .values({"should_exclude": False})
-                .where(Thread.user_id == user.id)
-            )
+            if unexclude_thread_ids:
+                db_session.execute(
+                    update(Thread)
+                    .values({"should_exclude": False})
+                    .where(Thread.id.in_(list(unexclude_thread_ids)))
+                )
+            if exclude_thread_ids:
+                db_session.execute(
+                    update(Thread)
+                    .values({"should_exclude": True})
+                    .where(Thread.id.in_(list(exclude_thread_ids)))
+                )
+            db_session.commit()
             break
         except psycopg2.errors.DeadlockDetected as e:
             log(job_details, "deadlock detected, sleeping 10s and trying again")
             time.sleep(10)
 
-    # Set should_exclude for all threads based on the settings
-    if user.tweets_threads_threshold:
-        threads = db_session.scalars(
-            select(Thread)
-            .join(Thread.tweets)
-            .where(Thread.id == Tweet.thread_id)
-            .where(Thread.user_id == user.id)
-            .where(Tweet.user_id == user.id)
-            .where(Tweet.is_deleted == False)
-            .where(Tweet.is_retweet == False)
-            .where(Tweet.retweet_count >= user.tweets_retweet_threshold)
-            .where(Tweet.like_count >= user.tweets_like_threshold)
-        ).fetchall()
-        for thread in threads:
-            thread.should_exclude = True
-            db_session.add(thread)
-
-        db_session.commit()
-
     data["progress"]["status"] = "Finished"
     job_details.data = json.dumps(data)
     db_session.add(job_details)
@@ -448,22 +563,141 @@ def fetch(job_details, user, funcs):
         # Create DM job
         add_dm_job(funcs, user.twitter_id, message)
 
-    job_details.status = "finished"
-    job_details.finished_timestamp = datetime.now()
-    db_session.add(job_details)
-    db_session.commit()
+    # When maintain is running the fetch, the job keeps going with delete, so it stays
+    # active. Marking it finished in between would let another pending or active
+    # delete job in for this user, and then delete couldn't set it active again.
+    if disconnect:
+        job_details.status = "finished"
+        job_details.finished_timestamp = datetime.now()
+    progress.save()
 
     log(job_details, f"Fetch finished")
-    db_session.close()
 
-
-# Delete job
+    # If the fetch stopped partway through, the first part's changes weren't kept
+    if resumed:
+        return None
+    return changes
 
 
 @test_api_creds
 @validate_job
-def delete(job_details, user, funcs):
+def fetch(job_details, user, funcs):
+    changes = _fetch(job_details, user, funcs)
+    if changes != False:
+        db_session.close()
+    return changes
+
+
+# Delete job
+
+# Fall back to looking through everything if this much changed since the last run
+MAX_INCREMENTAL_CHANGES = 10000
+
+# Extra time to look back, so nothing falls through the cracks between runs
+DELETE_WINDOW_SLACK = timedelta(hours=1)
+
+
+def _delete_window(plan, days):
+    """
+    Anything older than the threshold the last time delete ran was already handled,
+    so only things created since then need to be looked at
+    """
+    try:
+        return (
+            datetime.utcfromtimestamp(plan["last_run"])
+            - timedelta(days=days)
+            - DELETE_WINDOW_SLACK
+        )
+    except OverflowError:
+        return datetime(2006, 7, 1)
+
+
+# With async twitter requests, progress is saved after every batch instead of after
+# every tweet
+ASYNC_BATCH_SIZE = 200
+
+
+def _destroy_each(job_details, user, api, data, items, endpoint, progress_key):
+    """
+    Call the endpoint (destroy_status or destroy_favorite) for each tweet or like,
+    mark them deleted, and count them in the progress. Tweets that are already gone
+    are marked deleted too, but other errors leave them to try again next time.
+    """
+    if ASYNC_TWITTER_CONCURRENCY:
+        asyncio.run(
+            _destroy_each_async(job_details, user, data, items, endpoint, progress_key)
+        )
+        return
+
+    with JobProgress(job_details, user, data) as progress:
+        for item in items:
+            try:
+                getattr(api, endpoint)(item.twitter_id)
+            except RetryLater:
+                raise
+            except tweepy.errors.NotFound:
+                pass
+            except Exception as e:
+                log(job_details, f"Error on {endpoint} {item.twitter_id}: {e}")
+                continue
+
+            item.is_deleted = True
+            db_session.add(item)
+
+            data["progress"][progress_key] += 1
+            progress.update()
+
+
+async def _destroy_each_async(job_details, user, data, items, endpoint, progress_key):
+    progress = JobProgress(job_details, user, data)
+    async with async_api_v1_1(user) as async_api:
+        for i in range(0, len(items), ASYNC_BATCH_SIZE):
+            batch = items[i : i + ASYNC_BATCH_SIZE]
+            results = await asyncio.gather(
+                *[getattr(async_api, endpoint)(item.twitter_id) for item in batch],
+                return_exceptions=True,
+            )
+
+            # Like _destroy_each, only mark what got deleted or was already gone
+            retry_later = None
+            for item, result in zip(batch, results):
+                if isinstance(result, RetryLater):
+                    retry_later = retry_later or result
+                    continue
+                if isinstance(result, Exception) and not isinstance(
+                    result, twitter_async.NotFound
+                ):
+                    log(job_details, f"Error on {endpoint} {item.twitter_id}: {result}")
+                    continue
+
+                item.is_deleted = True
+                db_session.add(item)
+                data["progress"][progress_key] += 1
+
+            progress.save()
+            if retry_later:
+                raise retry_later
+
+
+def _delete(job_details, user, funcs, changes=None):
+    """
+    Delete tweets, retweets, likes and DMs based on the user's settings. If changes
+    from the fetch that just ran are passed in, and nothing else changed since the
+    last run, only new tweets and likes, changed threads, and things that just got
+    old enough to delete are looked at.
+    """
+    # Start the progress, unless this job already started deleting and had to stop
+    # and wait
+    data = json.loads(job_details.data)
+    if data.get("checkpoint", {}).get("stage") != "delete":
+        data["progress"]["tweets_deleted"] = 0
+        data["progress"]["retweets_deleted"] = 0
+        data["progress"]["likes_deleted"] = 0
+        data["progress"]["dms_deleted"] = 0
+    data["checkpoint"] = {"stage": "delete"}
+
     job_details.status = "active"
+    job_details.data = json.dumps(data)
     db_session.add(job_details)
     db_session.commit()
     log(job_details, str(job_details))
@@ -471,12 +705,16 @@ def delete(job_details, user, funcs):
     api = tweepy_api_v1_1(user)
     log(job_details, "Delete started")
 
-    # Start the progress
-    data = json.loads(job_details.data)
-    data["progress"]["tweets_deleted"] = 0
-    data["progress"]["retweets_deleted"] = 0
-    data["progress"]["likes_deleted"] = 0
-    data["progress"]["dms_deleted"] = 0
+    now = time.time()
+    plan = get_delete_plan(user.id)
+    incremental = (
+        changes is not None
+        and plan is not None
+        and now - plan["full_scan"] < FULL_SCAN_INTERVAL.total_seconds()
+        and sum(len(ids) for ids in changes.values()) < MAX_INCREMENTAL_CHANGES
+    )
+    if incremental:
+        log(job_details, "Only looking at what changed since the last delete")
 
     # Unretweet and unlike tweets
     if user.retweets_likes:
@@ -488,14 +726,22 @@ def delete(job_details, user, funcs):
                 days = 99999
             datetime_threshold = datetime.utcnow() - timedelta(days=days)
 
-            tweets = db_session.scalars(
+            statement = (
                 select(Tweet)
                 .where(Tweet.user_id == user.id)
                 .where(Tweet.is_deleted == False)
                 .where(Tweet.is_retweet == True)
                 .where(Tweet.created_at < datetime_threshold)
                 .order_by(Tweet.created_at)
-            ).fetchall()
+            )
+            if incremental:
+                statement = statement.where(
+                    or_(
+                        Tweet.created_at >= _delete_window(plan, days),
+                        Tweet.twitter_id.in_(list(changes["tweet_ids"])),
+                    )
+                )
+            tweets = db_session.scalars(statement).fetchall()
 
             data["progress"][
                 "status"
@@ -504,21 +750,9 @@ def delete(job_details, user, funcs):
             db_session.add(job_details)
             db_session.commit()
 
-            for tweet in tweets:
-                # Delete retweet
-                try:
-                    api.destroy_status(tweet.twitter_id)
-                except Exception as e:
-                    pass
-
-                tweet.is_deleted = True
-                db_session.add(tweet)
-
-                data["progress"]["retweets_deleted"] += 1
-                job_details.data = json.dumps(data)
-                db_session.add(job_details)
-
-                db_session.commit()
+            _destroy_each(
+                job_details, user, api, data, tweets, "destroy_status", "retweets_deleted"
+            )
 
         # Unlike
         if user.retweets_likes_delete_likes:
@@ -526,13 +760,23 @@ def delete(job_details, user, funcs):
             if days > 99999:
                 days = 99999
             datetime_threshold = datetime.utcnow() - timedelta(days=days)
-            likes = db_session.scalars(
+            statement = (
                 select(Like)
                 .where(Like.user_id == user.id)
                 .where(Like.is_deleted == False)
                 .where(Like.created_at < datetime_threshold)
                 .order_by(Like.created_at)
-            ).fetchall()
+            )
+            if incremental:
+                # A like's created_at is when the liked tweet was posted, so new likes
+                # can be old
+                statement = statement.where(
+                    or_(
+                        Like.created_at >= _delete_window(plan, days),
+                        Like.twitter_id.in_(list(changes["like_ids"])),
+                    )
+                )
+            likes = db_session.scalars(statement).fetchall()
 
             data["progress"][
                 "status"
@@ -541,22 +785,9 @@ def delete(job_details, user, funcs):
             db_session.add(job_details)
             db_session.commit()
 
-            for like in likes:
-                # Delete like
-
-                try:
-                    api.destroy_favorite(like.twitter_id)
-                except Exception as e:
-                    pass
-
-                like.is_deleted = True
-                db_session.add(like)
-
-                data["progress"]["likes_deleted"] += 1
-                job_details.data = json.dumps(data)
-                db_session.add(job_details)
-
-                db_session.commit()
+            _destroy_each(
+                job_details, user, api, data, likes, "destroy_favorite", "likes_deleted"
+            )
 
     # Deleting tweets
     if user.delete_tweets:
@@ -586,6 +817,15 @@ def delete(job_details, user, funcs):
             )
         if user.tweets_enable_like_threshold:
             statement = statement.where(Tweet.like_count < user.tweets_like_threshold)
+        if incremental:
+            statement = statement.where(
+                or_(
+                    Tweet.created_at
+                    >= _delete_window(plan, user.tweets_days_threshold),
+                    Tweet.twitter_id.in_(list(changes["tweet_ids"])),
+                    Tweet.thread_id.in_(list(changes["thread_ids"])),
+                )
+            )
 
         tweets = db_session.scalars(statement).fetchall()
 
@@ -596,22 +836,9 @@ def delete(job_details, user, funcs):
         db_session.add(job_details)
         db_session.commit()
 
-        for tweet in tweets:
-            # Delete tweet
-            try:
-                api.destroy_status(tweet.twitter_id)
-            except Exception as e:
-                pass
-                # log(job_details, f"Error deleting tweet {tweet.twitter_id}: {e}")
-
-            tweet.is_deleted = True
-            db_session.add(tweet)
-
-            data["progress"]["tweets_deleted"] += 1
-            job_details.data = json.dumps(data)
-            db_session.add(job_details)
-
-            db_session.commit()
+        _destroy_each(
+            job_details, user, api, data, tweets, "destroy_status", "tweets_deleted"
+        )
 
     # Deleting direct messages
     if user.direct_messages:
@@ -623,6 +850,8 @@ def delete(job_details, user, funcs):
         try:
             dm_client.get_me()
             proceed = True
+        except RetryLater:
+            raise
         except Exception as e:
             # It doesn't, so disable deleting direct messages
             user.direct_messages = False
@@ -672,34 +901,51 @@ def delete(job_details, user, funcs):
                     # all done
                     break
 
-            for dm in dms:
-                created_timestamp = datetime.fromisoformat(dm["created_at"][0:19])
-                if created_timestamp <= datetime_threshold:
-                    # Delete the DM
-                    try:
-                        dm_api.delete_direct_message(dm["id"])
-                    except Exception as e:
-                        pass
-                        # log(job_details, f"Skipping DM {dm['id']}, {e}")
+            with JobProgress(job_details, user, data) as progress:
+                for dm in dms:
+                    created_timestamp = datetime.fromisoformat(dm["created_at"][0:19])
+                    if created_timestamp <= datetime_threshold:
+                        # Delete the DM
+                        try:
+                            dm_api.delete_direct_message(dm["id"])
+                        except RetryLater:
+                            raise
+                        except Exception as e:
+                            pass
+                            # log(job_details, f"Skipping DM {dm['id']}, {e}")
 
-                    data["progress"]["dms_deleted"] += 1
-                    job_details.data = json.dumps(data)
-                    db_session.add(job_details)
-                    db_session.commit()
+                        data["progress"]["dms_deleted"] += 1
+                        progress.update()
 
+    del data["checkpoint"]
     data["progress"]["status"] = "Finished"
-    job_details.data = json.dumps(data)
     job_details.status = "finished"
     job_details.finished_timestamp = datetime.now()
-    db_session.add(job_details)
-    db_session.commit()
+    JobProgress(job_details, user, data).save()
     log(job_details, f"Delete finished")
 
+    # Remember when this ran, so the next run only has to look at what's new. About as
+    # much becomes old enough to delete each day as gets fetched, so that's what the
+    # next run is expected to go through.
+    next_plan = {
+        "last_run": now,
+        "full_scan": plan["full_scan"] if incremental else now,
+    }
+    if changes is not None:
+        next_plan["cost"] = sum(len(ids) for ids in changes.values())
+    save_delete_plan(user.id, next_plan)
+
     # Delete is done!
 
-    # Schedule the next delete job
-    scheduled_timestamp = datetime.now() + timedelta(days=1)
-    add_job("delete", user.id, funcs, scheduled_timestamp=scheduled_timestamp)
+    # Schedule the next delete job in the user's daily slot
+    scheduled_timestamp = next_daily_run(user.id)
+    add_job(
+        "delete",
+        user.id,
+        funcs,
+        scheduled_timestamp=scheduled_timestamp,
+        cost=incremental_delete_cost(next_plan, scheduled_timestamp.timestamp()),
+    )
 
     # Has the user tipped in the last year?
     one_year = timedelta(days=365)
@@ -817,6 +1063,33 @@ def delete(job_details, user, funcs):
     db_session.close()
 
 
+@test_api_creds
+@validate_job
+def delete(job_details, user, funcs):
+    _delete(job_details, user, funcs)
+
+
+# Daily maintenance job
+
+
+@test_api_creds
+@validate_job
+def maintain(job_details, user, funcs):
+    """
+    Fetch and then delete, checking the user's API creds and the job just once, and
+    passing what the fetch changed along to delete
+    """
+    # If the job stopped to wait after the fetch finished, go straight to deleting
+    data = json.loads(job_details.data) if job_details.data else {}
+    if data.get("checkpoint", {}).get("stage") == "delete":
+        _delete(job_details, user, funcs)
+        return
+
+    changes = _fetch(job_details, user, funcs)
+    if changes != False:
+        _delete(job_details, user, funcs, changes)
+
+
 # Delete DMs and DM Groups jobs
 
 
@@ -847,6 +1120,8 @@ def delete_dms_job(job_details, user, dm_type, funcs):
     # Make sure the DMs API authenticates successfully
     try:
         dm_client.get_me()
+    except RetryLater:
+        raise
     except Exception as e:
         # It doesn't, so disable deleting direct messages
         log(job_details, f"DMs Twitter API creds don't work, canceling job")
@@ -861,14 +1136,17 @@ def delete_dms_job(job_details, user, dm_type, funcs):
     elif dm_type == "groups":
         log(job_details, f"Delete group DMs started")
 
-    # Start the progress
-    data = {
-        "progress": {
-            "dms_deleted": 0,
-            "dms_skipped": 0,
-            "status": "Verifying permissions",
+    # Start the progress, unless this job already started and had to stop and wait
+    data = json.loads(job_details.data) if job_details.data else {}
+    if "checkpoint" not in data:
+        data = {
+            "progress": {
+                "dms_deleted": 0,
+                "dms_skipped": 0,
+                "status": "Verifying permissions",
+            },
+            "checkpoint": {"dms_processed": 0},
         }
-    }
     job_details.data = json.dumps(data)
     db_session.add(job_details)
     db_session.commit()
@@ -918,28 +1196,36 @@ def delete_dms_job(job_details, user, dm_type, funcs):
     datetime_threshold = datetime.utcnow() - timedelta(
         days=user.direct_messages_threshold
     )
-    for obj in conversations:
-        conversation = obj["dmConversation"]
-        for message in conversation["messages"]:
-            if "messageCreate" in message:
-                created_str = message["messageCreate"]["createdAt"]
-                created_timestamp = datetime.strptime(
-                    created_str, "%Y-%m-%dT%H:%M:%S.%fZ"
-                )
-                if created_timestamp <= datetime_threshold:
-                    dm_id = message["messageCreate"]["id"]
-
-                    # Delete the DM
-                    try:
-                        dm_api.delete_direct_message(dm_id)
-                        data["progress"]["dms_deleted"] += 1
-                    except Exception as e:
-                        log(job_details, f"Error deleting DM {dm_id}, {e}")
-                        data["progress"]["dms_skipped"] += 1
-
-                    job_details.data = json.dumps(data)
-                    db_session.add(job_details)
-                    db_session.commit()
+    dms_processed = 0
+    with JobProgress(job_details, user, data) as progress:
+        for obj in conversations:
+            conversation = obj["dmConversation"]
+            for message in conversation["messages"]:
+                if "messageCreate" in message:
+                    created_str = message["messageCreate"]["createdAt"]
+                    created_timestamp = datetime.strptime(
+                        created_str, "%Y-%m-%dT%H:%M:%S.%fZ"
+                    )
+                    if created_timestamp <= datetime_threshold:
+                        dm_id = message["messageCreate"]["id"]
+
+                        # Skip the DMs that were already handled before the job stopped
+                        dms_processed += 1
+                        if dms_processed <= data["checkpoint"]["dms_processed"]:
+                            continue
+
+                        # Delete the DM
+                        try:
+                            dm_api.delete_direct_message(dm_id)
+                            data["progress"]["dms_deleted"] += 1
+                        except RetryLater:
+                            raise
+                        except Exception as e:
+                            log(job_details, f"Error deleting DM {dm_id}, {e}")
+                            data["progress"]["dms_skipped"] += 1
+
+                        data["checkpoint"]["dms_processed"] = dms_processed
+                        progress.update()
 
     # Delete the DM metadata file
     try:
@@ -947,12 +1233,11 @@ def delete_dms_job(job_details, user, dm_type, funcs):
     except:
         pass
 
+    del data["checkpoint"]
     data["progress"]["status"] = "Finished"
-    job_details.data = json.dumps(data)
     job_details.status = "finished"
     job_details.finished_timestamp = datetime.now()
-    db_session.add(job_details)
-    db_session.commit()
+    JobProgress(job_details, user, data).save()
     log(job_details, f"Delete DMs finished")
 
     # Send a DM to the user
@@ -1019,13 +1304,17 @@ def block(job_details_id, funcs):
                 unblock_timestamp = datetime.now() + timedelta(days=180)
             unblock_timestamp_formatted = unblock_timestamp.strftime("%B %-d, %Y")
 
+            # Cache the tweets they liked, so their dashboard can show them without
+            # looking them all up on twitter
+            try:
+                get_fascist_tweets([like.twitter_id for like in fascist_likes])
+            except Exception as e:
+                log(job_details, f"Error caching fascist tweets: {e}")
+
             # Send the DM
             message = f"You have liked {len(fascist_likes):,} tweets from a prominent fascist or fascist sympathizer within the last 6 months, so you have been blocked and your Semiphemeral account is deactivated.\n\nTo see which tweets you liked and learn how to get yourself unblocked, see https://{os.environ.get('DOMAIN')}/dashboard.\n\nOr you can wait until {unblock_timestamp_formatted} when you will get automatically unblocked, at which point you can login to reactivate your account so long as you've stop liking tweets from fascists."
             add_dm_job(funcs, user.twitter_id, message)
 
-            # Wait 65 seconds before blocking, to ensure they receive the DM
-            time.sleep(65)
-
             # Create the unblock job
             add_job(
                 "unblock",
@@ -1040,6 +1329,19 @@ def block(job_details_id, funcs):
                 scheduled_timestamp=unblock_timestamp,
             )
 
+            # Don't block until they receive the DM. Instead of sleeping, run this job
+            # again after the DM dispatcher has worked through the high priority queue.
+            eta = dm_dispatcher.queue_status()["high"]["eta"]
+            reschedule_job(
+                job_details,
+                funcs,
+                datetime.now() + timedelta(seconds=eta + 65),
+                job_timeout="10m",
+            )
+            log(job_details, f"Waiting for the DM to be sent before blocking")
+            db_session.close()
+            return
+
         # Block the user
         try:
             semiphemeral_client.block(data["twitter_id"], user_auth=True)
@@ -1205,6 +1507,184 @@ def dm(job_details_id, funcs):
 
     db_session.close()
 
-    # Sleep two minutes between sending each DM
-    log(job_details, f"Sleeping 2m")
-    time.sleep(120)
+
+# Stripe event job
+
+
+def _apply_stripe_event(stripe_payload):
+    """
+    Update tips based on a Stripe event, and return a message for the admin, if any.
+    Nothing gets committed, so the changes get saved along with marking the event
+    processed.
+    """
+    message = None
+
+    # Charge succeeded
+    if stripe_payload["type"] == "charge.succeeded":
+        log(None, "stripe_event: charge.succeeded")
+        amount_dollars = stripe_payload["data"]["object"]["amount"] / 100
+
+        tip = db_session.scalar(
+            select(Tip).where(
+                Tip.stripe_payment_intent
+                == stripe_payload["data"]["object"]["payment_intent"]
+            )
+        )
+        if tip:
+            # Update tip in database
+            log(None, "stripe_event: updating tip in database")
+            timestamp = datetime.utcfromtimestamp(
+                stripe_payload["data"]["object"]["created"]
+            )
+
+            tip.stripe_charge_id = stripe_payload["data"]["object"]["id"]
+            tip.receipt_url = stripe_payload["data"]["object"]["receipt_url"]
+            tip.paid = stripe_payload["data"]["object"]["paid"]
+            tip.refunded = stripe_payload["data"]["object"]["refunded"]
+            tip.amount = stripe_payload["data"]["object"]["amount"]
+            tip.timestamp = timestamp
+            db_session.add(tip)
+
+            user = db_session.scalar(select(User).where(User.id == tip.user_id))
+            if user:
+                message = f"https://twitter.com/{user.twitter_screen_name} tipped ${amount_dollars} with stripe"
+            else:
+                message = f"invalid user (id={tip.user_id}) tipped ${amount_dollars} with stripe"
+        else:
+            # This was probably a recurring tip
+            pass
+
+    # Recurring session has completed
+    elif stripe_payload["type"] == "checkout.session.completed":
+        log(None, "stripe_event: checkout.session.completed")
+        amount_dollars = stripe_payload["data"]["object"]["amount_total"] / 100
+        recurring_tip = db_session.scalar(
+            select(RecurringTip).where(
+                RecurringTip.stripe_checkout_session_id
+                == stripe_payload["data"]["object"]["id"]
+            )
+        )
+        if recurring_tip:
+            log(None, "stripe_event: updating recurring tip in database")
+
+            recurring_tip.stripe_customer_id = stripe_payload["data"]["object"][
+                "customer"
+            ]
+            recurring_tip.stripe_subscription_id = stripe_payload["data"]["object"][
+                "subscription"
+            ]
+            recurring_tip.amount = stripe_payload["data"]["object"]["amount_total"]
+            recurring_tip.status = "active"
+            db_session.add(recurring_tip)
+
+            user = db_session.scalar(
+                select(User).where(User.id == recurring_tip.user_id)
+            )
+            if user:
+                message = f"https://twitter.com/{user.twitter_screen_name} starting ${amount_dollars}/month tips with stripe"
+            else:
+                message = f"invalid user (id={recurring_tip.user_id}) starting ${amount_dollars}/month tips with stripe"
+        else:
+            log(None, "stripe_event: cannot find RecurringTip")
+
+    # Recurring tip paid
+    elif stripe_payload["type"] == "invoice.paid":
+        log(None, "stripe_event: invoice.paid")
+        amount_dollars = stripe_payload["data"]["object"]["amount_paid"] / 100
+        recurring_tip = db_session.scalar(
+            select(RecurringTip).where(
+                RecurringTip.stripe_customer_id
+                == stripe_payload["data"]["object"]["customer"]
+            )
+        )
+        if recurring_tip:
+            user = db_session.scalar(
+                select(User).where(User.id == recurring_tip.user_id)
+            )
+            if user:
+                timestamp = datetime.utcfromtimestamp(
+                    stripe_payload["data"]["object"]["created"]
+                )
+                tip = Tip(
+                    user_id=user.id,
+                    payment_processor="stripe",
+                    stripe_charge_id=stripe_payload["data"]["object"]["charge"],
+                    receipt_url=stripe_payload["data"]["object"]["hosted_invoice_url"],
+                    paid=stripe_payload["data"]["object"]["paid"],
+                    refunded=False,
+                    amount=stripe_payload["data"]["object"]["amount_paid"],
+                    timestamp=timestamp,
+                    recurring_tip_id=recurring_tip.id,
+                )
+                db_session.add(tip)
+                message = f"https://twitter.com/{user.twitter_screen_name} tipped ${amount_dollars} (monthly) with stripe"
+            else:
+                message = f"invalid user (id={recurring_tip.user_id}) tipped ${amount_dollars} (monthy) with stripe"
+        else:
+            # If there's no recurring tip, this was a one-time tip session
+            pass
+
+    # Recurring tip payment failed
+    elif stripe_payload["type"] == "invoice.payment_failed":
+        log(None, "stripe_event: invoice.payment_failed")
+        log(None, json.dumps(stripe_payload, indent=2))
+        message = "A recurring tip payment failed, look at docker logs and implement invoice.payment_failed"
+
+    # Refund a charge
+    elif stripe_payload["type"] == "charge.refunded":
+        log(None, "stripe_event: charge.refunded")
+        charge_id = stripe_payload["data"]["object"]["id"]
+        tip = db_session.scalar(select(Tip).where(Tip.stripe_charge_id == charge_id))
+        if tip:
+            tip.refunded = True
+            db_session.add(tip)
+
+    # All other callbacks
+    else:
+        log(None, f"stripe_event: {stripe_payload['type']} (not implemented)")
+
+    return message
+
+
+def stripe_event(job_details_id, funcs):
+    job_details = db_session.scalar(
+        select(JobDetails).where(JobDetails.id == job_details_id)
+    )
+    if not job_details or job_details.status == "canceled":
+        log(job_details, "Job already canceled, quitting early")
+        db_session.close()
+        return
+
+    job_details.status = "active"
+    job_details.started_timestamp = datetime.now()
+    db_session.add(job_details)
+    db_session.commit()
+    log(job_details, str(job_details))
+
+    data = json.loads(job_details.data)
+    event = db_session.scalar(
+        select(StripeEvent).where(StripeEvent.id == data["stripe_event_id"])
+    )
+
+    # Stripe sends events again if it doesn't hear back in time, so make sure each one
+    # only gets applied once
+    if event and event.status == "pending":
+        message = _apply_stripe_event(json.loads(event.payload))
+
+        event.status = "processed"
+        event.processed_timestamp = datetime.now()
+        db_session.add(event)
+        db_session.commit()
+
+        # Send notification to the admin
+        if message:
+            log(job_details, f"stripe_event: {message}")
+            send_admin_notification(message)
+    else:
+        log(job_details, f"Stripe event already processed")
+
+    job_details.status = "finished"
+    job_details.finished_timestamp = datetime.now()
+    db_session.add(job_details)
+    db_session.commit()
+    db_session.close()
@@ -1,58 +1,96 @@
 import os
+import json
 import time
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timedelta
 
 import worker_jobs
-from common import log, jobs_q, dm_jobs_high_q, dm_jobs_low_q, conn as redis_conn
+from common import (
+    log,
+    dm_jobs_high_q,
+    dm_jobs_low_q,
+    job_class_queues,
+    estimate_job_costs,
+    daily_slot,
+    DAILY_SLOTS,
+    conn as redis_conn,
+    FAILED_JOBS_KEY,
+    JOB_QUEUE_BACKEND,
+    MONITOR_READY_KEY,
+    MONITOR_READY_TTL,
+    invalidate_all_cached_users,
+)
 
-from sqlalchemy import select, update
+from sqlalchemy import select, update, values, column, Integer, String, DateTime
 from db import (
     User,
     JobDetails,
     session as db_session,
 )
 
-from rq.job import Job as RQJob
+from rq import Queue
+from rq.job import Job as RQJob, JobStatus
 from rq.registry import FailedJobRegistry
+from rq.exceptions import NoSuchJobError
 
 
-def enqueue_job(job_details, i=0, num_jobs=0):
+def _job_func(job_details):
+    """
+    Returns the function and timeout for a job
+    """
     func = None
-    job_id = None
     job_timeout = "10m"
 
     if job_details.job_type == "fetch":
         func = worker_jobs.fetch
-        job_id = job_details.id
         job_timeout = "24h"
     elif job_details.job_type == "delete":
         func = worker_jobs.delete
-        job_id = job_details.id
         job_timeout = "24h"
     elif job_details.job_type == "delete_dms":
         func = worker_jobs.delete_dms
-        job_id = job_details.id
         job_timeout = "24h"
     elif job_details.job_type == "delete_dm_groups":
         func = worker_jobs.delete_dm_groups
-        job_id = job_details.id
         job_timeout = "24h"
     elif job_details.job_type == "block":
         func = worker_jobs.block
-        job_id = job_details.id
     elif job_details.job_type == "unblock":
         func = worker_jobs.unblock
-        job_id = job_details.id
     elif job_details.job_type == "dm":
         func = worker_jobs.dm
-        job_id = job_details.id
+    elif job_details.job_type == "stripe_event":
+        func = worker_jobs.stripe_event
+
+    return func, job_timeout
+
+
+def _job_queue(job_details, costs):
+    """
+    Returns the queue and rq meta for a job. DM jobs go in the DM queues so they get
+    sent by the DM dispatcher, everything else goes in its job class's queue.
+    """
+    if job_details.job_type == "dm":
+        data = json.loads(job_details.data)
+        if data.get("priority") == "low":
+            return dm_jobs_low_q, None
+        return dm_jobs_high_q, None
+
+    job_class, cost = costs[job_details.id]
+    return job_class_queues[job_class], {"job_class": job_class, "cost": cost}
+
+
+def enqueue_job(job_details, i=0, num_jobs=0):
+    func, job_timeout = _job_func(job_details)
+    q, meta = _job_queue(job_details, estimate_job_costs([job_details]))
 
     if job_details.scheduled_timestamp:
-        redis_job = jobs_q.enqueue_at(
+        redis_job = q.enqueue_at(
             job_details.scheduled_timestamp,
             func,
-            job_id,
+            job_details.id,
             job_timeout=job_timeout,
+            meta=meta,
             # retry=RQRetry(max=3, interval=[60, 120, 240]),
         )
         log(
@@ -60,10 +98,11 @@ def enqueue_job(job_details, i=0, num_jobs=0):
             f"{i:,}/{num_jobs:,} Enqueued scheduled job for {job_details.scheduled_timestamp}",
         )
     else:
-        redis_job = jobs_q.enqueue(
+        redis_job = q.enqueue(
             func,
-            job_id,
+            job_details.id,
             job_timeout=job_timeout,
+            meta=meta,
             # retry=RQRetry(max=3, interval=[60, 120, 240]),
         )
         log(None, f"{i:,}/{num_jobs:,} Enqueued job ASAP")
@@ -73,9 +112,206 @@ def enqueue_job(job_details, i=0, num_jobs=0):
     db_session.commit()
 
 
+def enqueue_jobs(jobs, batch_size=1000):
+    """
+    Enqueue lots of jobs at once. Each batch is written to redis in a single pipeline,
+    and all of the batch's redis_ids are saved with a single UPDATE.
+    """
+    num_jobs = len(jobs)
+    for i in range(0, num_jobs, batch_size):
+        now = datetime.now()
+        batch = jobs[i : i + batch_size]
+
+        # Jobs that should run now are prepared per queue and enqueued together, jobs
+        # scheduled for the future go in the scheduled job registry
+        redis_ids = []
+        immediate = {}
+        costs = estimate_job_costs(batch)
+        with redis_conn.pipeline() as pipeline:
+            for job_details in batch:
+                func, job_timeout = _job_func(job_details)
+                if not func:
+                    log(None, f"Skipping job with unknown job_type: {job_details}")
+                    continue
+
+                # Skip any job that can't be enqueued instead of giving up on the rest
+                try:
+                    q, meta = _job_queue(job_details, costs)
+
+                    if (
+                        job_details.scheduled_timestamp
+                        and job_details.scheduled_timestamp > now
+                    ):
+                        redis_job = q.create_job(
+                            func,
+                            args=(job_details.id,),
+                            timeout=job_timeout,
+                            status=JobStatus.SCHEDULED,
+                            meta=meta,
+                        )
+                        q.schedule_job(
+                            redis_job,
+                            job_details.scheduled_timestamp,
+                            pipeline=pipeline,
+                        )
+                        redis_ids.append((job_details.id, redis_job.id))
+                    else:
+                        job_data = Queue.prepare_data(
+                            func,
+                            args=(job_details.id,),
+                            timeout=job_timeout,
+                            meta=meta,
+                        )
+                        if q.name not in immediate:
+                            immediate[q.name] = (q, [], [])
+                        immediate[q.name][1].append(job_details.id)
+                        immediate[q.name][2].append(job_data)
+                except Exception as e:
+                    log(None, f"Skipping job_id={job_details.id}, can't enqueue: {e}")
+
+            for q, job_details_ids, job_datas in immediate.values():
+                redis_jobs = q.enqueue_many(job_datas, pipeline=pipeline)
+                for job_details_id, redis_job in zip(job_details_ids, redis_jobs):
+                    redis_ids.append((job_details_id, redis_job.id))
+
+            pipeline.execute()
+
+        if not redis_ids:
+            continue
+
+        # Save the redis_ids
+        redis_ids_values = values(
+            column("id", Integer), column("redis_id", String), name="redis_ids"
+        ).data(redis_ids)
+        db_session.execute(
+            update(JobDetails)
+            .where(JobDetails.id == redis_ids_values.c.id)
+            .values(redis_id=redis_ids_values.c.redis_id)
+            .execution_options(synchronize_session=False)
+        )
+        db_session.commit()
+
+        log(None, f"{i + len(batch):,}/{num_jobs:,} Enqueued jobs")
+
+
+# Overdue delete jobs get spread out over this long when monitor starts, instead of
+# all running at once
+CATCH_UP_WINDOW = int(os.environ.get("CATCH_UP_WINDOW", 3600))
+
+
+def spread_overdue_jobs(jobs):
+    """
+    Give overdue delete jobs a new scheduled_timestamp within the catch up window,
+    in the same order as the users' daily slots. Jobs that were active when monitor
+    started are left alone, so they pick up where they left off.
+    """
+    now = datetime.now()
+    spread = []
+    for job_details in jobs:
+        if (
+            job_details.job_type == "delete"
+            and job_details.started_timestamp is None
+            and job_details.scheduled_timestamp
+            and job_details.scheduled_timestamp < now
+        ):
+            offset = daily_slot(job_details.user_id) * CATCH_UP_WINDOW // DAILY_SLOTS
+            job_details.scheduled_timestamp = now + timedelta(seconds=offset)
+            spread.append((job_details.id, job_details.scheduled_timestamp))
+
+    # Save the new scheduled_timestamps with a single UPDATE
+    if spread:
+        spread_values = values(
+            column("id", Integer),
+            column("scheduled_timestamp", DateTime),
+            name="spread",
+        ).data(spread)
+        db_session.execute(
+            update(JobDetails)
+            .where(JobDetails.id == spread_values.c.id)
+            .values(scheduled_timestamp=spread_values.c.scheduled_timestamp)
+            .execution_options(synchronize_session=False)
+        )
+        db_session.commit()
+    log(None, f"Spread {len(spread):,} overdue delete jobs over {CATCH_UP_WINDOW}s")
+
+
+# How often to check the failed job registries for failures the workers didn't report
+SWEEP_INTERVAL = 60
+
+# How often to refresh MONITOR_READY_KEY, well before it expires
+READY_REFRESH_INTERVAL = MONITOR_READY_TTL // 3
+
+
+class SeenJobIds:
+    """
+    Set of job ids that have already been handled, which forgets the oldest ones once
+    it gets too big
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.job_ids = set()
+        self.order = deque()
+
+    def __contains__(self, job_id):
+        return job_id in self.job_ids
+
+    def add(self, job_id):
+        if job_id in self.job_ids:
+            return
+        self.job_ids.add(job_id)
+        self.order.append(job_id)
+        if len(self.order) > self.max_size:
+            self.job_ids.discard(self.order.popleft())
+
+
+def handle_failed_job(job_id, f, seen_job_ids):
+    """
+    Log the exception from a failed job, and if it was active, try it again
+    """
+    if job_id in seen_job_ids:
+        return
+    seen_job_ids.add(job_id)
+
+    try:
+        redis_job = RQJob.fetch(job_id, connection=redis_conn)
+    except NoSuchJobError:
+        return
+
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    f.write(f"job_id is {job_id}, timestamp is {now}\n")
+    f.write(str(redis_job.exc_info))
+    f.write("===\n")
+    f.flush()
+
+    job = db_session.scalar(select(JobDetails).where(JobDetails.redis_id == job_id))
+    if job and job.status == "active":
+        log(
+            None,
+            f"job {job.job_type} job_id={job.id} {redis_job.get_status()}: {redis_job.exc_info} (trying again)",
+        )
+        job.status = "pending"
+        db_session.add(job)
+        db_session.commit()
+        try:
+            enqueue_job(job)
+        except:
+            job.status = "canceled"
+            db_session.add(job)
+            db_session.commit()
+
+
+def set_ready():
+    redis_conn.set(MONITOR_READY_KEY, 1, ex=MONITOR_READY_TTL)
+
+
 def main():
+    # Workers wait until we're done getting the queues ready
+    redis_conn.delete(MONITOR_READY_KEY)
+
     # Empty the queues
-    jobs_q.empty()
+    for q in job_class_queues.values():
+        q.empty()
     dm_jobs_high_q.empty()
     dm_jobs_low_q.empty()
 
@@ -94,6 +330,7 @@ def main():
             .where(JobDetails.status == "pending")
         )
         db_session.commit()
+        invalidate_all_cached_users()
 
     # Mark active jobs pending
     log(None, "Make 'active' jobs 'pending'")
@@ -104,66 +341,65 @@ def main():
     )
     db_session.commit()
 
+    # With the postgres job queue, workers pick up pending jobs and retry failed ones
+    # on their own
+    if JOB_QUEUE_BACKEND == "postgres":
+        log(None, "Using the postgres job queue, nothing to enqueue")
+        while True:
+            set_ready()
+            time.sleep(READY_REFRESH_INTERVAL)
+
     # Add pending jobs to the worker queues
     jobs = db_session.scalars(
         select(JobDetails)
         .where(JobDetails.status == "pending")
         .order_by(JobDetails.scheduled_timestamp)
     ).fetchall()
+
+    # Detach the jobs, so the commits while enqueueing them don't expire them and
+    # reload each one from the database
+    db_session.expunge_all()
+
+    spread_overdue_jobs(jobs)
     num_jobs = len(jobs)
     log(None, f"Enqueing {num_jobs:,} jobs")
-    i = 0
-    for job_details in jobs:
-        try:
-            enqueue_job(job_details, i, num_jobs)
-        except:
-            pass
-        i += 1
+    enqueue_jobs(jobs)
+    set_ready()
+
+    # Watch for failed jobs
+    registries = [
+        FailedJobRegistry(queue=q)
+        for q in list(job_class_queues.values()) + [dm_jobs_high_q, dm_jobs_low_q]
+    ]
+
+    # Failed job registries are sorted sets scored by expiration time, so newly failed
+    # jobs always score at least as high as the ones that were already there
+    watermarks = {}
+    for registry in registries:
+        newest = redis_conn.zrevrange(registry.key, 0, 0, withscores=True)
+        watermarks[registry.key] = newest[0][1] if newest else 0
 
-    jobs_registry = FailedJobRegistry(queue=jobs_q)
+    seen_job_ids = SeenJobIds()
+    last_sweep = time.time()
     with open("/var/web/exceptions.log", "a") as f:
-        logged_job_ids = []
         while True:
-            # Log exceptions
-            exceptions_logged = 0
-            for job_id in jobs_registry.get_job_ids():
-                if job_id not in logged_job_ids:
-                    try:
-                        job = RQJob.fetch(job_id, connection=redis_conn)
-                        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        f.write(f"job_id is {job_id}, timestamp is {now}\n")
-                        f.write(job.exc_info)
-                        f.write("===\n")
-                        f.flush()
-                        logged_job_ids.append(job_id)
-                        exceptions_logged += 1
-                    except:
-                        pass
-            if exceptions_logged > 0:
-                log(None, f"Logged {exceptions_logged} exceptions")
-
-            # Retry failed jobs
-            active_jobs = db_session.scalars(
-                select(JobDetails).where(JobDetails.status == "active")
-            ).fetchall()
-            for job in active_jobs:
-                try:
-                    redis_job = RQJob.fetch(job.redis_id, connection=redis_conn)
-                    if redis_job.get_status() in ["failed", "canceled"]:
-                        log(
-                            None,
-                            f"job {job.job_type} job_id={job.id} {redis_job.get_status()}: {redis_job.exc_info} (trying again)",
-                        )
-                        job.status = "pending"
-                        db_session.add(job)
-                        db_session.commit()
-                        enqueue_job(job)
-                except:
-                    job.status = "canceled"
-                    db_session.add(job)
-                    db_session.commit()
-
-            time.sleep(300)
+            set_ready()
+
+            # Workers report failed jobs as they happen
+            item = redis_conn.blpop(FAILED_JOBS_KEY, timeout=READY_REFRESH_INTERVAL)
+            if item:
+                handle_failed_job(item[1].decode(), f, seen_job_ids)
+
+            # Jobs can also fail without the worker reporting them, like if the work
+            # horse gets killed, so also check for anything new in the registries
+            if time.time() - last_sweep >= SWEEP_INTERVAL:
+                for registry in registries:
+                    for job_id, score in redis_conn.zrangebyscore(
+                        registry.key, watermarks[registry.key], "+inf", withscores=True
+                    ):
+                        handle_failed_job(job_id.decode(), f, seen_job_ids)
+                        watermarks[registry.key] = max(watermarks[registry.key], score)
+                last_sweep = time.time()
 
 
 if __name__ == "__main__":
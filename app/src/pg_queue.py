@@ -0,0 +1,117 @@
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from sqlalchemy import update, case
+from sqlalchemy.sql import text
+from db import JobDetails, engine as db_engine, session as db_session
+
+from common import log
+import dm_dispatcher
+
+# Job queue that uses the job_details table itself, instead of redis. Workers claim
+# pending jobs with SELECT ... FOR UPDATE SKIP LOCKED, so they never block each other
+# and never claim the same job twice. Enable it with JOB_QUEUE_BACKEND=postgres.
+#
+# Jobs run in the worker's process, so job timeouts aren't enforced like they are
+# with rq.
+
+POLL_INTERVAL = 1
+RETRY_DELAY = timedelta(minutes=5)
+
+# After failing this many times a job is marked failed instead of tried again
+MAX_ATTEMPTS = 5
+
+_claim_job_sql = """
+UPDATE job_details
+SET status = 'active', started_timestamp = NOW()
+WHERE id = (
+    SELECT id
+    FROM job_details
+    WHERE
+        status = 'pending'
+        AND job_type = ANY(:job_types)
+        AND (scheduled_timestamp IS NULL OR scheduled_timestamp <= NOW())
+    ORDER BY {order_by}
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING id, job_type
+"""
+
+_claim_job = text(_claim_job_sql.format(order_by="scheduled_timestamp"))
+
+# High priority DMs get sent before low priority ones, and DMs without a priority are
+# high priority
+_claim_dm_job = text(
+    _claim_job_sql.format(
+        order_by="COALESCE(CAST(data AS jsonb) ->> 'priority', 'high') = 'low', "
+        + "scheduled_timestamp"
+    )
+)
+
+
+def claim_job(job_types, dms=False):
+    """
+    Mark the next pending job that's ready to run active, and return its id and
+    job_type, or None if there's nothing to do
+    """
+    with db_engine.begin() as conn:
+        return conn.execute(
+            _claim_dm_job if dms else _claim_job, {"job_types": job_types}
+        ).first()
+
+
+def run_next_job(job_types, funcs, dms=False):
+    """
+    Claim and run the next job. Returns False if there were no jobs ready.
+    """
+    row = claim_job(job_types, dms)
+    if not row:
+        return False
+
+    job_details_id, job_type = row
+    if dms:
+        dm_dispatcher.wait_for_send_slot()
+
+    try:
+        funcs[job_type](job_details_id)
+    except Exception:
+        log(
+            None,
+            f"pg_queue: job {job_type} job_id={job_details_id} failed (trying again in {RETRY_DELAY}, unless it's failed {MAX_ATTEMPTS} times): {traceback.format_exc()}",
+        )
+        db_session.rollback()
+        out_of_attempts = JobDetails.attempts + 1 >= MAX_ATTEMPTS
+        db_session.execute(
+            update(JobDetails)
+            .where(JobDetails.id == job_details_id)
+            .where(JobDetails.status == "active")
+            .values(
+                attempts=JobDetails.attempts + 1,
+                status=case((out_of_attempts, "failed"), else_="pending"),
+                scheduled_timestamp=case(
+                    (out_of_attempts, JobDetails.scheduled_timestamp),
+                    else_=datetime.now() + RETRY_DELAY,
+                ),
+                finished_timestamp=case(
+                    (out_of_attempts, datetime.now()),
+                    else_=JobDetails.finished_timestamp,
+                ),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        db_session.commit()
+        db_session.close()
+
+    return True
+
+
+def work(job_types, funcs, dms=False):
+    """
+    Run jobs forever
+    """
+    log(None, f"pg_queue: starting worker for {', '.join(job_types)}")
+    while True:
+        if not run_next_job(job_types, funcs, dms):
+            time.sleep(POLL_INTERVAL)
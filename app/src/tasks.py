@@ -22,10 +22,15 @@ from common import (
     delete_user,
     add_job,
     add_dm_job,
+    get_creds_status,
+    rate_limit_status,
     conn,
-    jobs_q,
+    job_class_queues,
+    STARTUP_LATENCY_KEY,
 )
 import worker_jobs
+import dm_dispatcher
+import job_scheduler
 
 import rq
 from rq.job import Job as RQJob
@@ -110,10 +115,7 @@ def cleanup_users():
             f"\r[{i:,}/{count:,}] checking @{user.twitter_screen_name} ..." + " " * 20,
             end="",
         )
-        api = tweepy_api_v1_1(user)
-        try:
-            api.verify_credentials()
-        except tweepy.errors.Unauthorized:
+        if not get_creds_status(user)["valid"]:
             print(
                 f"\r[{i:,}/{count:,}, deleted {users_deleted:,}] deleting @{user.twitter_screen_name}"
             )
@@ -171,12 +173,70 @@ def cleanup_dm_jobs():
     short_help="View failed jobs from the redis queue",
 )
 def failed_jobs_registry():
-    registry = FailedJobRegistry(queue=jobs_q)
+    for q in job_class_queues.values():
+        registry = FailedJobRegistry(queue=q)
 
-    # Show all failed job IDs and the exceptions they caused during runtime
-    for job_id in registry.get_job_ids():
-        job = RQJob.fetch(job_id, connection=conn)
-        print(job_id, job.exc_info)
+        # Show all failed job IDs and the exceptions they caused during runtime
+        for job_id in registry.get_job_ids():
+            job = RQJob.fetch(job_id, connection=conn)
+            print(job_id, job.exc_info)
+
+
+@main.command(
+    "dm-queue-status",
+    short_help="Show how many DMs are queued, and how long until they're sent",
+)
+def dm_queue_status():
+    status = dm_dispatcher.queue_status()
+    print(f"Sending {status['rate_per_hour']} DMs per hour")
+    for priority in ["high", "low"]:
+        print(
+            f"{priority}: {status[priority]['depth']:,} queued, {status[priority]['scheduled']:,} scheduled, ETA {timedelta(seconds=status[priority]['eta'])}"
+        )
+
+
+@main.command(
+    "job-classes-status",
+    short_help="Show queued jobs and recent worker time for each job class",
+)
+def job_classes_status():
+    served = job_scheduler.served()
+    for job_class, q in job_class_queues.items():
+        print(
+            f"{job_class}: {q.count:,} queued, {q.scheduled_job_registry.count:,} scheduled, weight {job_scheduler.JOB_CLASS_WEIGHTS[job_class]}, cost started in the last {job_scheduler.WINDOW_MINUTES}m {served[job_class]:,.0f}"
+        )
+
+
+@main.command(
+    "rate-limits",
+    short_help="Show how many twitter API calls are left for each token and endpoint",
+)
+@click.option("--limit", default=50, help="How many to show")
+def rate_limits(limit):
+    now = datetime.now().timestamp()
+    for bucket in rate_limit_status(limit):
+        resets_in = timedelta(seconds=max(0, int(bucket["reset"] - now)))
+        print(
+            f"{bucket['label']} {bucket['endpoint']}: {bucket['remaining']:,}/{bucket['limit']:,} left, resets in {resets_in}"
+        )
+
+
+@main.command(
+    "worker-stats",
+    short_help="Show how long it takes workers to start running jobs",
+)
+def worker_stats():
+    latencies = sorted(float(x) for x in conn.lrange(STARTUP_LATENCY_KEY, 0, -1))
+    if not latencies:
+        print("No jobs have started yet")
+        return
+
+    count = len(latencies)
+    print(f"Startup latency over the last {count:,} jobs:")
+    print(f"avg: {sum(latencies) / count * 1000:.1f}ms")
+    print(f"p50: {latencies[count // 2] * 1000:.1f}ms")
+    print(f"p95: {latencies[min(count - 1, int(count * 0.95))] * 1000:.1f}ms")
+    print(f"max: {latencies[-1] * 1000:.1f}ms")
 
 
 # TODO: fix this to make it use v1.1 API
@@ -243,44 +303,6 @@ def fix_stalled_users():
     db_session.close()
 
 
-@main.command(
-    "cancel-dupe-jobs",
-    short_help="Each user should have at most 1 fetch and 1 delete job, this cancels dupes",
-)
-def cancel_dupe_jobs():
-    i = 0
-    users = db_session.scalars(
-        select(User).where(User.blocked == False).where(User.paused == False)
-    ).fetchall()
-    count = len(users)
-    for user in users:
-        for job_type in ["fetch", "delete"]:
-            pending_jobs = db_session.scalars(
-                select(JobDetails)
-                .where(JobDetails.user_id == user.id)
-                .where(JobDetails.status == "pending")
-                .where(JobDetails.job_type == job_type)
-            )
-            if len(pending_jobs) > 1:
-                skipped_first = False
-                for job in pending_jobs:
-                    if not skipped_first:
-                        skipped_first = True
-                        continue
-
-                    job.status = "canceled"
-                    job.finished_timestamp = datetime.now()
-                    db_session.add(job)
-                    db_session.commit()
-                    print(
-                        f"{i:,}/{count:,} @{user.twitter_screen_name} canceled {job_type} job {job.id}"
-                    )
-
-        i += 1
-
-    db_session.close()
-
-
 @main.command(
     "count-deletes",
     short_help="Count total things deleted from twitter",
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# common and db connect lazily, so these only need to look right
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+os.environ.setdefault("DATABASE_URI", "postgresql://semiphemeral@localhost/semiphemeral")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
@@ -0,0 +1,60 @@
+import time
+
+import pytest
+import requests
+
+import common
+from common import RetryLater, create_tweepy_api_1_1, retry_later_on_waits
+
+
+def _api(name):
+    # Each test gets its own tokens so it doesn't share a pooled client
+    return create_tweepy_api_1_1("consumer", "secret", f"token-{name}", "token-secret")
+
+
+def _response(status_code, headers):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers)
+    response._content = b'{"errors": [{"code": 88, "message": "Rate limit exceeded"}]}'
+    response.url = "https://api.twitter.com/1.1/statuses/destroy/1.json"
+    return response
+
+
+@pytest.fixture(autouse=True)
+def no_redis(monkeypatch):
+    monkeypatch.setattr(common, "log", lambda *args: None)
+    monkeypatch.setattr(common, "record_rate_limit", lambda *args: None)
+    monkeypatch.setattr(common, "rate_limit_wait", lambda token, endpoint: 0)
+
+
+def test_destroy_status_raises_retry_later_when_ledger_is_empty(monkeypatch):
+    monkeypatch.setattr(common, "rate_limit_wait", lambda token, endpoint: 600)
+
+    def no_request(*args, **kwargs):
+        raise AssertionError("request made with no calls left")
+
+    monkeypatch.setattr(requests.Session, "request", no_request)
+
+    api = _api("ledger")
+    with retry_later_on_waits():
+        with pytest.raises(RetryLater) as e:
+            api.destroy_status(1)
+    assert e.value.retry_at > time.time() + 500
+
+
+def test_destroy_status_raises_retry_later_on_429(monkeypatch):
+    reset = int(time.time()) + 900
+    monkeypatch.setattr(
+        requests.Session,
+        "request",
+        lambda *args, **kwargs: _response(
+            429, {"x-rate-limit-remaining": "0", "x-rate-limit-reset": str(reset)}
+        ),
+    )
+
+    api = _api("429")
+    with retry_later_on_waits():
+        with pytest.raises(RetryLater) as e:
+            api.destroy_status(1)
+    assert e.value.retry_at == reset + 1
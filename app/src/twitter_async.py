@@ -0,0 +1,270 @@
+import os
+import json
+import time
+import asyncio
+from urllib.parse import quote
+
+import aiohttp
+import redis
+from oauthlib import oauth1
+
+from common import (
+    log,
+    RetryLater,
+    should_retry_later,
+    rate_limit_endpoint,
+    rate_limit_label,
+    rate_limit_token,
+    rate_limit_wait,
+    record_rate_limit,
+)
+
+# Async client for the twitter API v1.1 endpoints that jobs use, so a job can have
+# lots of requests in flight at once instead of waiting for each one in turn.
+
+# How many requests each job keeps in flight, 0 means jobs make requests one at a time
+# with tweepy like usual
+ASYNC_TWITTER_CONCURRENCY = int(os.environ.get("ASYNC_TWITTER_CONCURRENCY", 0))
+
+
+class TwitterAPIError(Exception):
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+        super().__init__(f"{status} {body}")
+
+
+class Unauthorized(TwitterAPIError):
+    pass
+
+
+class NotFound(TwitterAPIError):
+    pass
+
+
+class AsyncTwitterAPI:
+    """
+    Signs requests with OAuth1 and keeps at most `concurrency` of them in flight. Like
+    RateLimitedSession, each request reserves a call from the rate limit ledger first,
+    and in jobs long waits raise RetryLater instead of sleeping.
+    """
+
+    def __init__(
+        self,
+        consumer_key,
+        consumer_secret,
+        access_token,
+        access_token_secret,
+        concurrency=20,
+        host="api.twitter.com",
+        verify_ssl=True,
+    ):
+        self.oauth = oauth1.Client(
+            consumer_key,
+            client_secret=consumer_secret,
+            resource_owner_key=access_token,
+            resource_owner_secret=access_token_secret,
+        )
+        self.concurrency = concurrency
+        self.host = host
+        self.verify_ssl = verify_ssl
+        self.session = None
+        self.semaphore = None
+        self.resume_at = 0
+        self.token = rate_limit_token(consumer_key, access_token)
+        self.label = rate_limit_label(access_token)
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.concurrency, ssl=None if self.verify_ssl else False
+            )
+        )
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
+
+    async def wait_for_rate_limit(self, endpoint):
+        """
+        Wait until a call can be reserved from the ledger, or raise RetryLater if that
+        would take too long
+        """
+        while True:
+            wait = self.resume_at - time.time()
+            if wait <= 0:
+                try:
+                    wait = rate_limit_wait(self.token, endpoint)
+                except redis.exceptions.RedisError as e:
+                    log(None, f"Rate limit ledger: {e}")
+                    return
+                if wait <= 0:
+                    return
+                wait += 1
+
+            if should_retry_later(wait):
+                raise RetryLater(time.time() + wait, f"Rate limited on {endpoint}")
+            await asyncio.sleep(wait)
+
+    async def request(self, method, endpoint, params=None, json_body=None):
+        url = f"https://{self.host}/1.1/{endpoint}.json"
+        limit_endpoint = rate_limit_endpoint(url)
+        if params:
+            # oauthlib needs the query string to be part of the url it signs
+            query = "&".join(
+                f"{key}={quote(str(value), safe='')}"
+                for key, value in params.items()
+                if value is not None
+            )
+            url = f"{url}?{query}"
+
+        async with self.semaphore:
+            while True:
+                await self.wait_for_rate_limit(limit_endpoint)
+
+                headers = {}
+                body = None
+                if json_body is not None:
+                    headers["Content-Type"] = "application/json"
+                    body = json.dumps(json_body)
+                signed_url, signed_headers, _ = self.oauth.sign(
+                    url, method, headers=headers
+                )
+
+                async with self.session.request(
+                    method, signed_url, headers=signed_headers, data=body
+                ) as response:
+                    try:
+                        record_rate_limit(
+                            self.token, self.label, limit_endpoint, response
+                        )
+                    except redis.exceptions.RedisError as e:
+                        log(None, f"Rate limit ledger: {e}")
+
+                    if response.status == 429:
+                        reset_time = response.headers.get("x-rate-limit-reset")
+                        if reset_time is None:
+                            retry_at = time.time() + 60
+                        else:
+                            retry_at = int(reset_time) + 1
+                        if should_retry_later(retry_at - time.time()):
+                            raise RetryLater(
+                                retry_at, f"Rate limited on {limit_endpoint}"
+                            )
+                        self.resume_at = max(self.resume_at, retry_at)
+                        continue
+
+                    text = await response.text()
+                    if response.status == 401:
+                        raise Unauthorized(response.status, text)
+                    if response.status == 404:
+                        raise NotFound(response.status, text)
+                    if response.status >= 400:
+                        raise TwitterAPIError(response.status, text)
+                    if not text:
+                        return None
+                    return json.loads(text)
+
+    # Tweets
+
+    async def get_status(self, id):
+        return await self.request("GET", "statuses/show", {"id": id})
+
+    async def lookup_statuses(self, ids):
+        return await self.request(
+            "GET", "statuses/lookup", {"id": ",".join(str(id) for id in ids)}
+        )
+
+    async def user_timeline(self, user_id, since_id=None, max_id=None, count=200):
+        return await self.request(
+            "GET",
+            "statuses/user_timeline",
+            {
+                "user_id": user_id,
+                "since_id": since_id,
+                "max_id": max_id,
+                "count": count,
+            },
+        )
+
+    async def destroy_status(self, id):
+        return await self.request("POST", f"statuses/destroy/{id}")
+
+    # Likes
+
+    async def get_favorites(self, user_id, since_id=None, max_id=None, count=200):
+        return await self.request(
+            "GET",
+            "favorites/list",
+            {
+                "user_id": user_id,
+                "since_id": since_id,
+                "max_id": max_id,
+                "count": count,
+            },
+        )
+
+    async def destroy_favorite(self, id):
+        return await self.request("POST", "favorites/destroy", {"id": id})
+
+    # DMs
+
+    async def send_direct_message(self, recipient_id, text):
+        return await self.request(
+            "POST",
+            "direct_messages/events/new",
+            json_body={
+                "event": {
+                    "type": "message_create",
+                    "message_create": {
+                        "target": {"recipient_id": recipient_id},
+                        "message_data": {"text": text},
+                    },
+                }
+            },
+        )
+
+    async def delete_direct_message(self, id):
+        return await self.request(
+            "DELETE", "direct_messages/events/destroy", {"id": id}
+        )
+
+    # Friendships and blocks
+
+    async def lookup_friendships(self, user_ids):
+        return await self.request(
+            "GET",
+            "friendships/lookup",
+            {"user_id": ",".join(str(id) for id in user_ids)},
+        )
+
+    async def create_friendship(self, user_id):
+        return await self.request("POST", "friendships/create", {"user_id": user_id})
+
+    async def create_block(self, user_id):
+        return await self.request("POST", "blocks/create", {"user_id": user_id})
+
+    async def destroy_block(self, user_id):
+        return await self.request("POST", "blocks/destroy", {"user_id": user_id})
+
+
+def async_api_v1_1(user, dms=False, concurrency=None):
+    if dms:
+        consumer_key = os.environ.get("TWITTER_DM_CONSUMER_TOKEN")
+        consumer_secret = os.environ.get("TWITTER_DM_CONSUMER_KEY")
+        access_token = user.twitter_dms_access_token
+        access_token_secret = user.twitter_dms_access_token_secret
+    else:
+        consumer_key = os.environ.get("TWITTER_CONSUMER_TOKEN")
+        consumer_secret = os.environ.get("TWITTER_CONSUMER_KEY")
+        access_token = user.twitter_access_token
+        access_token_secret = user.twitter_access_token_secret
+
+    return AsyncTwitterAPI(
+        consumer_key,
+        consumer_secret,
+        access_token,
+        access_token_secret,
+        concurrency=concurrency or ASYNC_TWITTER_CONCURRENCY or 20,
+    )
@@ -2,11 +2,23 @@
 import os
 import csv
 import json
+import time
 from datetime import datetime, timedelta
 import stripe
 import tweepy
 
-from sqlalchemy import select, update, delete, or_
+from sqlalchemy import (
+    select,
+    update,
+    delete,
+    or_,
+    and_,
+    case,
+    func,
+    DateTime,
+)
+from sqlalchemy.orm import Session as DBSession, aliased, make_transient_to_detached
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.sql import text
 from db import (
     User,
@@ -16,13 +28,13 @@ from db import (
     Like,
     Fascist,
     JobDetails,
+    StripeEvent,
     engine as db_engine,
     session as db_session,
 )
 
 from common import (
     log,
-    send_admin_notification,
     delete_user,
     create_tweepy_api_1_1,
     tweepy_api_v1_1,
@@ -33,6 +45,14 @@ from common import (
     dm_jobs_high_q,
     add_job,
     add_dm_job,
+    invalidate_delete_plan,
+    get_creds_status,
+    cache_creds_status,
+    rate_limit_status,
+    get_fascist_tweets,
+    job_progress_channel,
+    user_cache_key,
+    USER_CACHE_CREDENTIAL_COLUMNS,
     conn as redis_conn,
 )
 
@@ -44,11 +64,14 @@ from flask import (
     request,
     jsonify,
     render_template,
+    Response,
+    g,
 )
 from flask_session import Session
 from functools import wraps
 
 import worker_jobs
+import dm_dispatcher
 
 import rq
 from rq.job import Job as RQJob
@@ -74,27 +97,76 @@ def _is_admin(user):
     return user.twitter_screen_name in admin_usernames
 
 
+# Users get looked up on every API call, so keep them for the rest of the request,
+# and for a little while in redis
+USER_CACHE_TTL = 30
+
+
+def _user_to_cache(user):
+    values = {}
+    for column in User.__table__.columns:
+        if column.name in USER_CACHE_CREDENTIAL_COLUMNS:
+            continue
+        value = getattr(user, column.name)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        values[column.name] = value
+    return values
+
+
+def _user_from_cache(values):
+    for column in User.__table__.columns:
+        if isinstance(column.type, DateTime) and values.get(column.name):
+            values[column.name] = datetime.fromisoformat(values[column.name])
+    user = User(**values)
+
+    # Add it to the database session as if it had just been loaded, so changes to it
+    # get saved like usual
+    make_transient_to_detached(user)
+    user = db_session.merge(user, load=False)
+
+    # Load the credentials from the database if they get used
+    db_session.expire(user, USER_CACHE_CREDENTIAL_COLUMNS)
+    return user
+
+
+def _get_user(twitter_id):
+    """
+    Look up a user by twitter_id, using the request and redis caches
+    """
+    users = g.setdefault("users", {})
+    if twitter_id in users:
+        return users[twitter_id]
+
+    cached = redis_conn.get(user_cache_key(twitter_id))
+    if cached:
+        user = _user_from_cache(json.loads(cached))
+    else:
+        user = db_session.scalar(select(User).where(User.twitter_id == twitter_id))
+        if user:
+            redis_conn.set(
+                user_cache_key(twitter_id),
+                json.dumps(_user_to_cache(user)),
+                ex=USER_CACHE_TTL,
+            )
+
+    users[twitter_id] = user
+    return user
+
+
 def _logged_in_user():
     """
     Return the currently logged in user
     """
     if session.get("twitter_id"):
-        user = db_session.scalar(
-            select(User).where(User.twitter_id == session.get("twitter_id"))
-        )
+        user = _get_user(session.get("twitter_id"))
         if not user:
             session["twitter_id"] = None
             return None
 
         # Are we the administrator impersonating another user?
         if _is_admin(user) and session.get("impersonating_twitter_id"):
-            impersonating_user = db_session.scalar(
-                select(User).where(
-                    User.twitter_id == session.get("impersonating_twitter_id")
-                )
-            )
-
-            return impersonating_user
+            return _get_user(session.get("impersonating_twitter_id"))
 
         return user
 
@@ -124,10 +196,8 @@ def _api_validate(expected_fields, json_data):
 
 def _api_validate_dms_authenticated(user):
     # Check if user is authenticated with DMs twitter app
-    dms_api = tweepy_dms_api_v1_1(user)
     try:
-        dms_api.verify_credentials()
-        return True
+        return get_creds_status(user, dms=True)["valid"]
     except Exception as e:
         return False
 
@@ -164,9 +234,7 @@ def admin_required(f):
     def decorator(*args, **kwargs):
         current_user = _logged_in_user()
         if session.get("impersonating_twitter_id"):
-            user = db_session.scalar(
-                select(User).where(User.twitter_id == session.get("twitter_id"))
-            )
+            user = _get_user(session.get("twitter_id"))
             if not user or not _is_admin(user):
                 return redirect("/", 302)
         else:
@@ -308,6 +376,9 @@ def auth_twitter_callback():
         db_session.add(user)
         db_session.commit()
 
+    # We just verified the new creds
+    cache_creds_status(user.id, response)
+
     # Redirect to app
     return redirect("/dashboard", code=302)
 
@@ -366,6 +437,9 @@ def auth_twitter_dms_callback():
         db_session.add(user)
         db_session.commit()
 
+        # We just verified the new creds
+        cache_creds_status(user.id, response, dms=True)
+
     # Redirect to settings page again
     return redirect("/settings", code=302)
 
@@ -375,150 +449,55 @@ def auth_twitter_dms_callback():
 
 @app.route("/stripe/callback", methods=["POST"])
 def stripe_callback():
+    """
+    Save the event and add a job to handle it, so stripe gets a response right away.
+    Events are saved by their id, so if stripe sends one again it only gets handled
+    once.
+    """
+    webhook_secret = os.environ.get("STRIPE_WEBHOOK_SECRET_KEY")
+    if webhook_secret:
+        try:
+            stripe.WebhookSignature.verify_header(
+                request.data.decode(),
+                request.headers.get("Stripe-Signature", ""),
+                webhook_secret,
+            )
+        except stripe.error.SignatureVerificationError as e:
+            log(None, f"Invalid Stripe signature: {e}")
+            return jsonify(success=False), 400
+
     try:
         stripe_payload = json.loads(request.data)
     except Exception as e:
         log(None, f"Error parsing Stripe payload: {e}")
         return jsonify(success=False)
 
-    message = None
-
-    # TODO: verify webhook signatures
-    # webhook_secret = os.environ.get("STRIPE_WEBHOOK_SECRET_KEY")
-
-    # Charge succeeded
-    if stripe_payload["type"] == "charge.succeeded":
-        log(None, "stripe_callback: charge.succeeded")
-        amount_dollars = stripe_payload["data"]["object"]["amount"] / 100
-
-        tip = db_session.scalar(
-            select(Tip).where(
-                Tip.stripe_payment_intent
-                == stripe_payload["data"]["object"]["payment_intent"]
-            )
-        )
-        if tip:
-            # Update tip in database
-            print("stripe_callback: updating tip in database")
-            timestamp = datetime.utcfromtimestamp(
-                stripe_payload["data"]["object"]["created"]
-            )
-
-            tip.stripe_charge_id = stripe_payload["data"]["object"]["id"]
-            tip.receipt_url = stripe_payload["data"]["object"]["receipt_url"]
-            tip.paid = stripe_payload["data"]["object"]["paid"]
-            tip.refunded = stripe_payload["data"]["object"]["refunded"]
-            tip.amount = stripe_payload["data"]["object"]["amount"]
-            tip.timestamp = timestamp
-            db_session.add(tip)
-            db_session.commit()
-
-            user = db_session.scalar(select(User).where(User.id == tip.user_id))
-            if user:
-                message = f"https://twitter.com/{user.twitter_screen_name} tipped ${amount_dollars} with stripe"
-            else:
-                message = f"invalid user (id={tip.user_id}) tipped ${amount_dollars} with stripe"
-        else:
-            # This was probably a recurring tip
-            pass
-
-    # Recurring session has completed
-    elif stripe_payload["type"] == "checkout.session.completed":
-        log(None, "stripe_callback: checkout.session.completed")
-        amount_dollars = stripe_payload["data"]["object"]["amount_total"] / 100
-        recurring_tip = db_session.scalar(
-            select(RecurringTip).where(
-                RecurringTip.stripe_checkout_session_id
-                == stripe_payload["data"]["object"]["id"]
-            )
+    log(None, f"stripe_callback: {stripe_payload['type']} {stripe_payload['id']}")
+    stripe_event_id = db_session.execute(
+        insert(StripeEvent)
+        .values(
+            id=stripe_payload["id"],
+            event_type=stripe_payload["type"],
+            payload=request.data.decode(),
+            status="pending",
+            received_timestamp=datetime.now(),
         )
-        if recurring_tip:
-            log(None, "stripe_callback: updating recurring tip in database")
-
-            recurring_tip.stripe_customer_id = stripe_payload["data"]["object"][
-                "customer"
-            ]
-            recurring_tip.stripe_subscription_id = stripe_payload["data"]["object"][
-                "subscription"
-            ]
-            recurring_tip.amount = stripe_payload["data"]["object"]["amount_total"]
-            recurring_tip.status = "active"
-            db_session.add(recurring_tip)
-            db_session.commit()
-
-            user = db_session.scalar(
-                select(User).where(User.id == recurring_tip.user_id)
-            )
-            if user:
-                message = f"https://twitter.com/{user.twitter_screen_name} starting ${amount_dollars}/month tips with stripe"
-            else:
-                message = f"invalid user (id={tip.user_id}) starting ${amount_dollars}/month tips with stripe"
-        else:
-            log(None, "stripe_callback: cannot find RecurringTip")
-
-    # Recurring tip paid
-    elif stripe_payload["type"] == "invoice.paid":
-        log(None, "stripe_callback: invoice.paid")
-        amount_dollars = stripe_payload["data"]["object"]["amount_paid"] / 100
-        recurring_tip = db_session.scalar(
-            select(RecurringTip).where(
-                RecurringTip.stripe_customer_id
-                == stripe_payload["data"]["object"]["customer"]
-            )
-        )
-        if recurring_tip:
-            user = db_session.scalar(
-                select(User).where(User.id == recurring_tip.user_id)
-            )
-            if user:
-                timestamp = datetime.utcfromtimestamp(
-                    stripe_payload["data"]["object"]["created"]
-                )
-                tip = Tip(
-                    user_id=user.id,
-                    payment_processor="stripe",
-                    stripe_charge_id=stripe_payload["data"]["object"]["charge"],
-                    receipt_url=stripe_payload["data"]["object"]["hosted_invoice_url"],
-                    paid=stripe_payload["data"]["object"]["paid"],
-                    refunded=False,
-                    amount=stripe_payload["data"]["object"]["amount_paid"],
-                    timestamp=timestamp,
-                    recurring_tip_id=recurring_tip.id,
-                )
-                db_session.add(tip)
-                db_session.commit()
-                message = f"https://twitter.com/{user.twitter_screen_name} tipped ${amount_dollars} (monthly) with stripe"
-            else:
-                message = f"invalid user (id={tip.user_id}) tipped ${amount_dollars} (monthy) with stripe"
-        else:
-            # If there's no recurring tip, this was a one-time tip session
-            pass
-
-    # Recurring tip payment failed
-    elif stripe_payload["type"] == "invoice.payment_failed":
-        log(None, "stripe_callback: invoice.payment_failed")
-        log(None, json.dumps(stripe_payload, indent=2))
-        message = "A recurring tip payment failed, look at docker logs and implement invoice.payment_failed"
-
-    # Refund a charge
-    elif stripe_payload["type"] == "charge.refunded":
-        log(None, "stripe_callback: charge.refunded")
-        charge_id = stripe_payload["data"]["object"]["id"]
-        tip = db_session.scalar(select(Tip).where(Tip.stripe_charge_id == charge_id))
-        if tip:
-            tip.refunded = True
-            db_session.add(tip)
-            db_session.commit()
-
-    # All other callbacks
-    else:
-        log(None, f"stripe_callback: {stripe_payload['type']} (not implemented)")
-
-    # Send notification to the admin
-    if message:
-        log(None, f"stripe_callback: {message}")
-        send_admin_notification(message)
-
+        .on_conflict_do_nothing(index_elements=["id"])
+        .returning(StripeEvent.id)
+    ).scalar()
+    if stripe_event_id is None:
+        db_session.rollback()
+        log(None, f"stripe_callback: already received {stripe_payload['id']}")
+        return jsonify(success=True)
+
+    # add_job commits the event along with the job
+    add_job(
+        "stripe_event",
+        None,
+        worker_jobs.funcs,
+        data={"stripe_event_id": stripe_event_id},
+        job_timeout="10m",
+    )
     return jsonify(success=True)
 
 
@@ -591,11 +570,11 @@ def api_user(current_user):
             f"Admin impersonating user @{current_user.twitter_screen_name}",
         )
 
-    api = tweepy_api_v1_1(current_user)
     try:
-        response = api.verify_credentials()
-        profile_image_url_https = response.profile_image_url_https
+        profile_image_url_https = get_creds_status(current_user)["profile_image_url"]
     except:
+        profile_image_url_https = None
+    if not profile_image_url_https:
         profile_image_url_https = "/images/egg.png"
 
     return jsonify(
@@ -775,6 +754,9 @@ def api_settings(current_user):
             db_session.add(current_user)
             db_session.commit()
 
+            # The next delete needs to look through everything with the new settings
+            invalidate_delete_plan(current_user.id)
+
             return jsonify(True)
 
         if data["action"] == "authenticate_dms":
@@ -1063,63 +1045,154 @@ def api_tip_recent(current_user):
     return jsonify({"receipt_url": receipt_url})
 
 
+# How many finished jobs to show in the dashboard log at a time
+DASHBOARD_FINISHED_JOBS_LIMIT = 20
+DASHBOARD_FINISHED_JOBS_MAX_LIMIT = 200
+
+
+def _job_to_client(job):
+    if job.scheduled_timestamp:
+        scheduled_timestamp = job.scheduled_timestamp.timestamp()
+    else:
+        scheduled_timestamp = None
+    if job.started_timestamp:
+        started_timestamp = job.started_timestamp.timestamp()
+    else:
+        started_timestamp = None
+    if job.finished_timestamp:
+        finished_timestamp = job.finished_timestamp.timestamp()
+    else:
+        finished_timestamp = None
+
+    return {
+        "id": job.id,
+        "job_type": job.job_type,
+        "data": job.data,
+        "status": job.status,
+        "scheduled_timestamp": scheduled_timestamp,
+        "started_timestamp": started_timestamp,
+        "finished_timestamp": finished_timestamp,
+    }
+
+
+def _dashboard_jobs(user_id, limit):
+    """
+    Get a user's pending, active, and most recent finished jobs, and a summary of
+    them, in a single query
+    """
+    ranked = (
+        select(
+            JobDetails,
+            func.row_number()
+            .over(
+                partition_by=JobDetails.status,
+                order_by=(JobDetails.finished_timestamp.desc(), JobDetails.id.desc()),
+            )
+            .label("n"),
+            func.count().over(partition_by=JobDetails.status).label("num_jobs"),
+            func.max(JobDetails.finished_timestamp)
+            .filter(JobDetails.job_type == "fetch")
+            .over(partition_by=JobDetails.status)
+            .label("last_fetch_finished"),
+        )
+        .where(JobDetails.user_id == user_id)
+        .where(JobDetails.status.in_(["pending", "active", "finished"]))
+        .subquery()
+    )
+    ranked_job = aliased(JobDetails, ranked)
+    rows = db_session.execute(
+        select(ranked_job, ranked.c.num_jobs, ranked.c.last_fetch_finished)
+        .where(or_(ranked.c.status != "finished", ranked.c.n <= limit))
+        .order_by(
+            ranked.c.status,
+            case((ranked.c.status == "pending", ranked.c.scheduled_timestamp)),
+            case((ranked.c.status == "active", ranked.c.started_timestamp)),
+            ranked.c.n,
+        )
+    ).all()
+
+    jobs = {"pending": [], "active": [], "finished": []}
+    summary = {"pending": 0, "active": 0, "finished": 0, "last_fetch_finished": None}
+    for job, num_jobs, last_fetch_finished in rows:
+        jobs[job.status].append(job)
+        summary[job.status] = num_jobs
+        if job.status == "finished" and last_fetch_finished:
+            summary["last_fetch_finished"] = last_fetch_finished.timestamp()
+
+    return jobs, summary
+
+
+def _finished_jobs_page(user_id, before, limit):
+    """
+    Get the next limit + 1 finished jobs after the job with id before, so the caller
+    can tell if there are more
+    """
+    before_timestamp = db_session.scalar(
+        select(JobDetails.finished_timestamp).where(JobDetails.id == before)
+    )
+    if before_timestamp is None:
+        # Jobs without a finished_timestamp sort first, by id, and then come the rest
+        after_before = or_(
+            JobDetails.finished_timestamp.is_not(None),
+            JobDetails.id < before,
+        )
+    else:
+        after_before = or_(
+            JobDetails.finished_timestamp < before_timestamp,
+            and_(
+                JobDetails.finished_timestamp == before_timestamp,
+                JobDetails.id < before,
+            ),
+        )
+
+    return db_session.scalars(
+        select(JobDetails)
+        .where(JobDetails.user_id == user_id)
+        .where(JobDetails.status == "finished")
+        .where(after_before)
+        .order_by(JobDetails.finished_timestamp.desc(), JobDetails.id.desc())
+        .limit(limit + 1)
+    ).fetchall()
+
+
 @app.route("/api/dashboard", methods=["GET", "POST"])
 @authentication_required_401
 def api_dashboard(current_user):
     """
-    GET: Respond with the current user's list of active and pending jobs
+    GET: Respond with the current user's active, pending, and recently finished jobs.
+    Pass before=<job id> to get the next page of finished jobs.
     POST: Start or pause semiphemeral, or fetch.
     """
     if request.method == "GET":
-        pending_jobs = db_session.scalars(
-            select(JobDetails)
-            .where(JobDetails.user_id == current_user.id)
-            .where(JobDetails.status == "pending")
-            .order_by(JobDetails.scheduled_timestamp)
-        ).fetchall()
-
-        active_jobs = db_session.scalars(
-            select(JobDetails)
-            .where(JobDetails.user_id == current_user.id)
-            .where(JobDetails.status == "active")
-            .order_by(JobDetails.started_timestamp)
-        ).fetchall()
+        try:
+            limit = int(request.args.get("limit", DASHBOARD_FINISHED_JOBS_LIMIT))
+        except ValueError:
+            return "limit must be an integer", 400
+        limit = max(1, min(limit, DASHBOARD_FINISHED_JOBS_MAX_LIMIT))
 
-        finished_jobs = db_session.scalars(
-            select(JobDetails)
-            .where(JobDetails.user_id == current_user.id)
-            .where(JobDetails.status == "finished")
-            .order_by(JobDetails.finished_timestamp.desc())
-        ).fetchall()
+        # Loading more of the log only needs the next page of finished jobs
+        if request.args.get("before"):
+            try:
+                before = int(request.args.get("before"))
+            except ValueError:
+                return "before must be a job id", 400
 
-        def to_client(jobs):
-            jobs_json = []
-            for job in jobs:
-                if job.scheduled_timestamp:
-                    scheduled_timestamp = job.scheduled_timestamp.timestamp()
-                else:
-                    scheduled_timestamp = None
-                if job.started_timestamp:
-                    started_timestamp = job.started_timestamp.timestamp()
-                else:
-                    started_timestamp = None
-                if job.finished_timestamp:
-                    finished_timestamp = job.finished_timestamp.timestamp()
-                else:
-                    finished_timestamp = None
+            finished_jobs = _finished_jobs_page(current_user.id, before, limit)
+            return jsonify(
+                {
+                    "finished_jobs": [
+                        _job_to_client(job) for job in finished_jobs[:limit]
+                    ],
+                    "finished_jobs_next": (
+                        finished_jobs[limit - 1].id
+                        if len(finished_jobs) > limit
+                        else None
+                    ),
+                }
+            )
 
-                jobs_json.append(
-                    {
-                        "id": job.id,
-                        "job_type": job.job_type,
-                        "data": job.data,
-                        "status": job.status,
-                        "scheduled_timestamp": scheduled_timestamp,
-                        "started_timestamp": started_timestamp,
-                        "finished_timestamp": finished_timestamp,
-                    }
-                )
-            return jobs_json
+        jobs, summary = _dashboard_jobs(current_user.id, limit)
+        finished_jobs = jobs["finished"]
 
         fascist_likes = []
         fascist_likes_to_client = []
@@ -1134,27 +1207,20 @@ def api_dashboard(current_user):
                 .order_by(Like.created_at.desc())
             ).fetchall()
 
-            # use the Semiphemeral API, so we don't need to authenticate with the blocked user's creds
-            api = tweepy_semiphemeral_api_1_1()
+            # Tweets get cached when the user is blocked, so these are usually already
+            # there without asking twitter
+            try:
+                tweets = get_fascist_tweets([like.twitter_id for like in fascist_likes])
+            except Exception as e:
+                log(None, f"Error looking up fascist tweets: {e}")
+                tweets = {}
 
             for like in fascist_likes:
-                response = api.get_status(like.twitter_id)
-                try:
-                    text = response.text
-                except:
-                    text = ""
-                try:
-                    created_at = response.created_at.timestamp()
-                except:
-                    created_at = 0
-                try:
-                    name = response.author.name
-                except:
-                    name = ""
-                try:
-                    username = response.author.screen_name
-                except:
-                    username = ""
+                tweet = tweets.get(like.twitter_id, {})
+                text = tweet.get("text", "")
+                created_at = tweet.get("created_at", 0)
+                name = tweet.get("name", "")
+                username = tweet.get("username", "")
 
                 if username != "":
                     permalink = (
@@ -1177,9 +1243,15 @@ def api_dashboard(current_user):
 
         return jsonify(
             {
-                "pending_jobs": to_client(pending_jobs),
-                "active_jobs": to_client(active_jobs),
-                "finished_jobs": to_client(finished_jobs),
+                "pending_jobs": [_job_to_client(job) for job in jobs["pending"]],
+                "active_jobs": [_job_to_client(job) for job in jobs["active"]],
+                "finished_jobs": [_job_to_client(job) for job in finished_jobs],
+                "finished_jobs_next": (
+                    finished_jobs[-1].id
+                    if summary["finished"] > len(finished_jobs)
+                    else None
+                ),
+                "summary": summary,
                 "setting_paused": current_user.paused,
                 "setting_blocked": current_user.blocked,
                 "setting_delete_tweets": current_user.delete_tweets,
@@ -1326,6 +1398,60 @@ def api_dashboard(current_user):
         return "Bad request", 400
 
 
+# Dashboards stay subscribed to their user's job progress for this long before
+# reconnecting, and get a comment this often to keep the connection open
+EVENTS_STREAM_SECONDS = 600
+EVENTS_KEEPALIVE_SECONDS = 15
+
+
+@app.route("/api/dashboard/events")
+def api_dashboard_events():
+    """
+    Stream the current user's job progress as server-sent events. This holds a
+    connection open, so it gets served by the threaded events service instead of the
+    web workers. The global database session isn't safe to share between threads, so
+    the user gets looked up in a session of its own.
+    """
+    if not session.get("twitter_id"):
+        return "Authentication required", 401
+
+    # The same rules as _logged_in_user
+    with DBSession(db_engine) as events_db_session:
+        user = events_db_session.scalar(
+            select(User).where(User.twitter_id == session.get("twitter_id"))
+        )
+        if user and _is_admin(user) and session.get("impersonating_twitter_id"):
+            user = events_db_session.scalar(
+                select(User).where(
+                    User.twitter_id == session.get("impersonating_twitter_id")
+                )
+            )
+        if not user:
+            return "Authentication required", 401
+        twitter_id = user.twitter_id
+
+    def stream():
+        pubsub = redis_conn.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(job_progress_channel(twitter_id))
+        try:
+            yield "retry: 5000\n\n"
+            stop_at = time.monotonic() + EVENTS_STREAM_SECONDS
+            while time.monotonic() < stop_at:
+                message = pubsub.get_message(timeout=EVENTS_KEEPALIVE_SECONDS)
+                if message:
+                    yield f"data: {message['data'].decode()}\n\n"
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            pubsub.close()
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.route("/api/tweets", methods=["GET", "POST"])
 @authentication_required_401
 def api_tweets(current_user):
@@ -1383,6 +1509,10 @@ def api_tweets(current_user):
         db_session.add(tweet)
         db_session.commit()
 
+        # If the tweet isn't excluded anymore, the next delete should find it
+        if not data["exclude"]:
+            invalidate_delete_plan(current_user.id)
+
         return jsonify(True)
 
     else:
@@ -1543,68 +1673,130 @@ def api_dms(current_user):
 ## Admin API routes
 
 
-@app.route("/admin_api/jobs")
-@admin_required
-def admin_api_jobs(current_user):
+# The admin jobs page gets refreshed a lot, and counting jobs means looking at all the
+# pending ones, so the counts get cached for a few seconds
+ADMIN_JOB_COUNTS_TTL = 10
+ADMIN_JOB_COUNTS_KEY = "admin:job_counts"
+
+
+def _admin_job_counts():
     """
-    Get information about current jobs
+    Count the pending and scheduled fetch and delete jobs, and how many jobs are
+    scheduled and started each hour
     """
-    active_jobs = db_session.scalars(
-        select(JobDetails)
-        .where(JobDetails.status == "active")
-        .order_by(JobDetails.started_timestamp)
-    ).fetchall()
+    job_counts = redis_conn.get(ADMIN_JOB_COUNTS_KEY)
+    if job_counts:
+        return json.loads(job_counts)
 
-    with db_engine.connect() as conn:
-        pending_jobs_count = conn.execute(
+    with db_engine.connect() as db_conn:
+        pending_jobs_count, scheduled_jobs_count = db_conn.execute(
             text(
                 """SELECT
-	COUNT(id)
+	COUNT(id) FILTER (WHERE scheduled_timestamp IS NULL OR scheduled_timestamp <= NOW()),
+	COUNT(id) FILTER (WHERE scheduled_timestamp > NOW())
 FROM
 	job_details
 WHERE
 	status = 'pending'
 	AND (job_type = 'fetch' OR job_type = 'delete')
-	AND (scheduled_timestamp IS NULL OR scheduled_timestamp <= NOW())
     """
             )
-        ).scalar()
-        scheduled_jobs_count = conn.execute(
+        ).one()
+
+        # How many fetch and delete jobs are scheduled for each of the next 24 hours,
+        # and how many started in each of the last 24 hours
+        scheduled_by_hour = db_conn.execute(
             text(
                 """SELECT
+	DATE_TRUNC('hour', GREATEST(scheduled_timestamp, LOCALTIMESTAMP)) AS hour,
 	COUNT(id)
 FROM
 	job_details
 WHERE
 	status = 'pending'
 	AND (job_type = 'fetch' OR job_type = 'delete')
-	AND scheduled_timestamp > NOW()
+	AND scheduled_timestamp < NOW() + INTERVAL '24 hours'
+GROUP BY hour
+    """
+            )
+        ).all()
+        started_by_hour = db_conn.execute(
+            text(
+                """SELECT
+	DATE_TRUNC('hour', started_timestamp) AS hour,
+	COUNT(id)
+FROM
+	job_details
+WHERE
+	(job_type = 'fetch' OR job_type = 'delete')
+	AND started_timestamp > NOW() - INTERVAL '24 hours'
+GROUP BY hour
     """
             )
-        ).scalar()
+        ).all()
+
+    this_hour = datetime.now().replace(minute=0, second=0, microsecond=0)
+    scheduled_by_hour = dict(scheduled_by_hour)
+    started_by_hour = dict(started_by_hour)
+    hourly_load = []
+    for i in range(-23, 24):
+        hour = this_hour + timedelta(hours=i)
+        hourly_load.append(
+            {
+                "hour": hour.timestamp(),
+                "started": started_by_hour.get(hour, 0),
+                "scheduled": scheduled_by_hour.get(hour, 0),
+            }
+        )
+
+    job_counts = {
+        "pending_jobs_count": pending_jobs_count,
+        "scheduled_jobs_count": scheduled_jobs_count,
+        "hourly_load": hourly_load,
+    }
+    redis_conn.set(ADMIN_JOB_COUNTS_KEY, json.dumps(job_counts), ex=ADMIN_JOB_COUNTS_TTL)
+    return job_counts
+
+
+@app.route("/admin_api/jobs")
+@admin_required
+def admin_api_jobs(current_user):
+    """
+    Get information about current jobs
+    """
+    active_jobs = db_session.execute(
+        select(JobDetails, User.twitter_screen_name)
+        .outerjoin(User, User.id == JobDetails.user_id)
+        .where(JobDetails.status == "active")
+        .order_by(JobDetails.started_timestamp)
+    ).all()
 
-    def to_client(job):
+    # Get the status of all of the jobs from redis at once
+    with redis_conn.pipeline() as pipeline:
+        for job, _ in active_jobs:
+            if job.redis_id:
+                pipeline.hget(RQJob.key_for(job.redis_id), "status")
+        redis_statuses = iter(pipeline.execute())
+
+    def to_client(job, twitter_screen_name):
         duration = datetime.now() - job.started_timestamp
         duration = str(duration).split(".")[0]
 
-        user = db_session.scalar(select(User).where(User.id == job.user_id))
-        if user:
-            twitter_username = user.twitter_screen_name
-            twitter_link = f"https://twitter.com/{user.twitter_screen_name}"
+        if twitter_screen_name:
+            twitter_link = f"https://twitter.com/{twitter_screen_name}"
         else:
-            twitter_username = None
             twitter_link = None
 
-        try:
-            redis_job = RQJob.fetch(job.redis_id, connection=conn)
-            redis_status = redis_job.get_status(refresh=True)
-        except:
+        redis_status = next(redis_statuses) if job.redis_id else None
+        if redis_status:
+            redis_status = redis_status.decode()
+        else:
             redis_status = "N/A"
 
         return {
             "id": job.id,
             "user_id": job.user_id,
-            "twitter_username": twitter_username,
+            "twitter_username": twitter_screen_name,
             "twitter_link": twitter_link,
             "job_type": job.job_type,
             "data": json.loads(job.data),
@@ -1613,36 +1805,67 @@ WHERE
             "redis_status": redis_status,
         }
 
+    active_jobs = [to_client(job, screen_name) for job, screen_name in active_jobs]
+    job_counts = _admin_job_counts()
+
     return jsonify(
         {
-            "active_jobs": [to_client(job) for job in active_jobs],
-            "pending_jobs_count": pending_jobs_count,
-            "scheduled_jobs_count": scheduled_jobs_count,
+            "active_jobs": active_jobs,
+            "pending_jobs_count": job_counts["pending_jobs_count"],
+            "scheduled_jobs_count": job_counts["scheduled_jobs_count"],
+            "dm_queues": dm_dispatcher.queue_status(),
+            "hourly_load": job_counts["hourly_load"],
+            "rate_limits": rate_limit_status(limit=20),
         }
     )
 
 
+ADMIN_USERS_PER_PAGE = 100
+
+
 @app.route("/admin_api/users")
 @admin_required
 def admin_api_users(current_user):
     """
-    Get information about users
+    Get a page of users with the given status, optionally only the ones whose
+    twitter_screen_name starts with q, and how many users have each status
     """
+    status = request.args.get("status", "active")
+    if status not in ["active", "paused", "blocked"]:
+        return "status must be 'active', 'paused', or 'blocked'", 400
+    try:
+        page = max(1, int(request.args.get("page", 1)))
+    except ValueError:
+        return "page must be an integer", 400
+    q = request.args.get("q", "").strip().lstrip("@").lower()
+
+    user_status = case(
+        (User.blocked == True, "blocked"),
+        (User.paused == True, "paused"),
+        else_="active",
+    )
+
+    def search(statement):
+        if q:
+            # Uses the lower(twitter_screen_name) text_pattern_ops index
+            return statement.where(
+                func.lower(User.twitter_screen_name).startswith(q, autoescape=True)
+            )
+        return statement
+
+    counts = {"active": 0, "paused": 0, "blocked": 0}
+    counts.update(
+        db_session.execute(
+            search(select(user_status, func.count(User.id)).group_by(user_status))
+        ).all()
+    )
+
     users = db_session.scalars(
-        select(User).order_by(User.twitter_screen_name)
+        search(select(User).where(user_status == status))
+        .order_by(User.twitter_screen_name)
+        .offset((page - 1) * ADMIN_USERS_PER_PAGE)
+        .limit(ADMIN_USERS_PER_PAGE)
     ).fetchall()
-    active_users = []
-    paused_users = []
-    blocked_users = []
-
-    for user in users:
-        if user.blocked:
-            blocked_users.append(user)
-        else:
-            if user.paused:
-                paused_users.append(user)
-            else:
-                active_users.append(user)
 
     def to_client(users):
         users_json = []
@@ -1671,9 +1894,14 @@ def admin_api_users(current_user):
         {
             "impersonating_twitter_id": impersonating_twitter_id,
             "impersonating_twitter_username": impersonating_twitter_username,
-            "active_users": to_client(active_users),
-            "paused_users": to_client(paused_users),
-            "blocked_users": to_client(blocked_users),
+            "status": status,
+            "q": q,
+            "page": page,
+            "num_pages": max(
+                1, (counts[status] + ADMIN_USERS_PER_PAGE - 1) // ADMIN_USERS_PER_PAGE
+            ),
+            "counts": counts,
+            "users": to_client(users),
         }
     )
 
@@ -1870,34 +2098,74 @@ def admin_api_fascists(current_user):
         return "Bad request", 400
 
 
+ADMIN_TIPS_PER_PAGE = 100
+
+
 @app.route("/admin_api/tips")
 @admin_required
 def admin_api_tips(current_user):
     """
-    Get all the tips
+    Get a page of paid tips, optionally only between the start and end dates, and
+    the totals for each month
     """
-    users = {}
-    tips = db_session.scalars(
-        select(Tip).where(Tip.paid == True).order_by(Tip.timestamp.desc())
-    ).fetchall()
-    for tip in tips:
-        if tip.user_id not in users:
-            user = db_session.scalar(select(User).where(User.id == tip.user_id))
-            if user:
-                users[tip.user_id] = {
-                    "twitter_username": user.twitter_screen_name,
-                    "twitter_link": f"https://twitter.com/{user.twitter_screen_name}",
-                }
-            else:
-                users[tip.user_id] = {"twitter_username": "", "twitter_link": ""}
+    try:
+        page = max(1, int(request.args.get("page", 1)))
+        start_date = request.args.get("start")
+        if start_date:
+            start_date = datetime.strptime(start_date, "%Y-%m-%d")
+        end_date = request.args.get("end")
+        if end_date:
+            end_date = datetime.strptime(end_date, "%Y-%m-%d") + timedelta(days=1)
+    except ValueError:
+        return "page must be an integer, and start and end must be YYYY-MM-DD", 400
+
+    def filter_tips(statement):
+        statement = statement.where(Tip.paid == True)
+        if start_date:
+            statement = statement.where(Tip.timestamp >= start_date)
+        if end_date:
+            statement = statement.where(Tip.timestamp < end_date)
+        return statement
+
+    month = func.date_trunc("month", Tip.timestamp).label("month")
+    monthly_totals = db_session.execute(
+        filter_tips(
+            select(
+                month,
+                func.count(Tip.id),
+                func.coalesce(
+                    func.sum(Tip.amount).filter(Tip.refunded.is_not(True)), 0
+                ),
+                func.coalesce(func.sum(Tip.amount).filter(Tip.refunded == True), 0),
+            )
+        )
+        .group_by(month)
+        .order_by(month.desc())
+    ).all()
+    num_tips = sum(num_month_tips for _, num_month_tips, _, _ in monthly_totals)
+
+    tips = db_session.execute(
+        filter_tips(
+            select(Tip, User.twitter_screen_name).outerjoin(
+                User, User.id == Tip.user_id
+            )
+        )
+        .order_by(Tip.timestamp.desc(), Tip.id.desc())
+        .offset((page - 1) * ADMIN_TIPS_PER_PAGE)
+        .limit(ADMIN_TIPS_PER_PAGE)
+    ).all()
 
     def to_client(tips):
         tips_json = []
-        for tip in tips:
+        for tip, twitter_screen_name in tips:
             tips_json.append(
                 {
-                    "twitter_username": users[tip.user_id]["twitter_username"],
-                    "twitter_link": users[tip.user_id]["twitter_link"],
+                    "twitter_username": twitter_screen_name or "",
+                    "twitter_link": (
+                        f"https://twitter.com/{twitter_screen_name}"
+                        if twitter_screen_name
+                        else ""
+                    ),
                     "timestamp": tip.timestamp.timestamp(),
                     "amount": tip.amount,
                     "paid": tip.paid,
@@ -1907,4 +2175,22 @@ def admin_api_tips(current_user):
             )
         return tips_json
 
-    return jsonify({"tips": to_client(tips)})
+    return jsonify(
+        {
+            "tips": to_client(tips),
+            "num_tips": num_tips,
+            "page": page,
+            "num_pages": max(
+                1, (num_tips + ADMIN_TIPS_PER_PAGE - 1) // ADMIN_TIPS_PER_PAGE
+            ),
+            "monthly_totals": [
+                {
+                    "month": month.timestamp(),
+                    "count": count,
+                    "amount": amount,
+                    "refunded_amount": refunded_amount,
+                }
+                for month, count, amount, refunded_amount in monthly_totals
+            ],
+        }
+    )
@@ -2,25 +2,120 @@ import time
 import sys
 import click
 
-from rq import Worker
-from common import conn as redis_conn, jobs_q, dm_jobs_high_q, dm_jobs_low_q
+from rq import Worker, SimpleWorker
+from common import (
+    log,
+    conn as redis_conn,
+    job_class_queues,
+    dm_jobs_high_q,
+    dm_jobs_low_q,
+    report_job_failure,
+    JOB_QUEUE_BACKEND,
+    MONITOR_READY_KEY,
+    STARTUP_LATENCY_KEY,
+)
+from dm_dispatcher import DMDispatcher
+from job_scheduler import WeightedWorker
+import pg_queue
+
+# Import all of the job code up front, so it's already loaded before the first job
+import worker_jobs
+
+# How long to wait for monitor to get the queues ready before starting anyway
+READY_TIMEOUT = 300
+
+# How many startup latency samples to keep
+STARTUP_LATENCY_SAMPLES = 1000
+
+
+class StartupTimer:
+    """
+    Record how long it takes from when the worker picks up a job until the job
+    actually starts running. For a forking worker this includes the fork.
+    """
+
+    def execute_job(self, job, queue):
+        self.execute_started = time.monotonic()
+        return super().execute_job(job, queue)
+
+    def perform_job(self, job, queue):
+        latency = time.monotonic() - self.execute_started
+        try:
+            pipe = redis_conn.pipeline()
+            pipe.lpush(STARTUP_LATENCY_KEY, f"{latency:.4f}")
+            pipe.ltrim(STARTUP_LATENCY_KEY, 0, STARTUP_LATENCY_SAMPLES - 1)
+            pipe.execute()
+        except Exception as e:
+            log(None, f"Failed to record startup latency: {e}")
+        return super().perform_job(job, queue)
+
+
+def wait_until_ready():
+    """
+    Wait for redis to come up, and for monitor to finish putting pending jobs back in
+    the queues
+    """
+    print("Waiting for the job queues to be ready ...", file=sys.stderr)
+    start = time.monotonic()
+    while time.monotonic() - start < READY_TIMEOUT:
+        try:
+            if redis_conn.ping() and redis_conn.exists(MONITOR_READY_KEY):
+                return
+        except Exception:
+            pass
+        time.sleep(1)
+
+    log(None, f"Job queues still not ready after {READY_TIMEOUT}s, starting anyway")
 
 
 @click.command()
 @click.option("--dms", is_flag=True, default=False)
-def main(dms):
-    # Wait 30s to ensure redis jobs have been flushed
-    print("Waiting 30s for jobs to be flushed ...", file=sys.stderr)
-    time.sleep(30)
+@click.option(
+    "--pool",
+    type=click.Choice(["all"] + list(job_class_queues)),
+    default="all",
+    help="Which job classes to work on, all of them share time based on their weights",
+)
+@click.option(
+    "--simple",
+    is_flag=True,
+    default=False,
+    help="Run jobs in the worker process instead of forking for each job",
+)
+def main(dms, pool, simple):
+    wait_until_ready()
+
+    if JOB_QUEUE_BACKEND == "postgres":
+        if dms:
+            pg_queue.work(["dm"], worker_jobs.funcs, dms=True)
+        else:
+            job_types = [job_type for job_type in worker_jobs.funcs if job_type != "dm"]
+            pg_queue.work(job_types, worker_jobs.funcs)
+        return
 
     if dms:
+        # The DM dispatcher drains high priority DMs first, at the global DM rate
         queues = [dm_jobs_high_q, dm_jobs_low_q]
+        bases = [DMDispatcher]
+    elif pool == "all":
+        queues = list(job_class_queues.values())
+        bases = [WeightedWorker]
     else:
-        queues = [jobs_q]
+        queues = [job_class_queues[pool]]
+        bases = []
+
+    # A simple worker keeps its database connections and loaded modules between
+    # jobs, but a job that crashes the process takes the worker down with it
+    bases += [StartupTimer, SimpleWorker if simple else Worker]
+    worker_class = type("SemiphemeralWorker", tuple(bases), {})
 
     # Start the worker
-    print("Starting worker", file=sys.stderr)
-    worker = Worker(queues, connection=redis_conn)
+    print(
+        f"Starting worker ({'simple' if simple else 'forking'})", file=sys.stderr
+    )
+    worker = worker_class(
+        queues, connection=redis_conn, exception_handlers=[report_job_failure]
+    )
     worker.work(with_scheduler=True)
 
 
@@ -1,4 +1,9 @@
+from datetime import datetime
+
+from sqlalchemy import select
+
 import jobs
+from db import JobDetails, session as db_session
 
 funcs = None
 
@@ -10,8 +15,7 @@ def fetch(job_details_id):
 
 def delete(job_details_id):
     global funcs
-    if jobs.fetch(job_details_id, funcs) != False:
-        jobs.delete(job_details_id, funcs)
+    jobs.maintain(job_details_id, funcs)
 
 
 def delete_dms(job_details_id):
@@ -39,6 +43,24 @@ def dm(job_details_id):
     jobs.dm(job_details_id, funcs)
 
 
+def stripe_event(job_details_id):
+    global funcs
+    jobs.stripe_event(job_details_id, funcs)
+
+
+def benchmark_noop(job_details_id):
+    # Used by benchmark_queues.py, it's here because rq can't enqueue functions from
+    # __main__
+    job_details = db_session.scalar(
+        select(JobDetails).where(JobDetails.id == job_details_id)
+    )
+    job_details.status = "finished"
+    job_details.finished_timestamp = datetime.now()
+    db_session.add(job_details)
+    db_session.commit()
+    db_session.close()
+
+
 funcs = {
     "fetch": fetch,
     "delete": delete,
@@ -47,4 +69,5 @@ funcs = {
     "block": block,
     "unblock": unblock,
     "dm": dm,
+    "stripe_event": stripe_event,
 }